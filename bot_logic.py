@@ -1,106 +1,381 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import logging
+import random
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 
-from telegram import Update
+import asyncpg
+import httpx
+from telegram import Bot, Message, Update
 from telegram.ext import ContextTypes
 
-from config import get_settings
+from config import Settings, get_settings
 from timeweb_ai import TimewebAIError, generate_funny_caption, generate_poll_options
 
 from db import (
     ensure_daily_poll,
     update_discussion_mapping,
-    maybe_cleanup_old_posts,
     record_post,
 )
 
 logger = logging.getLogger(__name__)
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DiscussionRef:
     discussion_chat_id: int
     discussion_message_id: int
-    ts: float
+    expires_at: float
 
 
 # key: (channel_chat_id, channel_message_id) -> DiscussionRef
-_DISCUSSION_MAP: dict[tuple[int, int], DiscussionRef] = {}
+_DISCUSSION_MAP: OrderedDict[tuple[int, int], DiscussionRef] = OrderedDict()
 _DISCUSSION_TTL_S = 60 * 60  # 1 час достаточно
+_DISCUSSION_MAX = 10_000
+
+# Сколько готовая подпись ждёт автофорвард поста в linked-чате.
+_DISCUSSION_WAIT_TIMEOUT_S = 30
 
 
 # Дедупликация: не отвечать на каждое фото в альбоме (media_group), а только один раз на пост.
-_PROCESSED_MEDIA_GROUPS: dict[str, float] = {}
+# value: момент истечения (time.monotonic())
+_PROCESSED_MEDIA_GROUPS: OrderedDict[str, float] = OrderedDict()
 _MEDIA_GROUP_TTL_S = 6 * 60 * 60  # 6 часов
+_MEDIA_GROUP_MAX = 10_000
 
 # Дедупликация сообщений канала на случай повторной доставки апдейта
-_PROCESSED_CHANNEL_MESSAGES: dict[tuple[int, int], float] = {}
+_PROCESSED_CHANNEL_MESSAGES: OrderedDict[tuple[int, int], float] = OrderedDict()
 _CHANNEL_MSG_TTL_S = 6 * 60 * 60
+_CHANNEL_MSG_MAX = 50_000
+
+
+# Общая куча сроков истечения для всех карт выше: (expires_at, map_id, key).
+# Один фоновый sweeper снимает с вершины всё просроченное, не обходя карты целиком.
+# Дополнительно каждая карта ограничена по размеру (LRU): попадание переносит ключ в конец,
+# при переполнении вытесняется давнее всех использованная запись.
+_MAP_DISCUSSION = 0
+_MAP_MEDIA_GROUPS = 1
+_MAP_CHANNEL_MESSAGES = 2
+_MAP_FILE_PATHS = 3
+_MAP_PENDING_COMMENTS = 4
+_EXPIRY_HEAP: list[tuple[float, int, object]] = []
+_DEDUP_SWEEP_INTERVAL_S = 30
+
+
+@dataclass(frozen=True, slots=True)
+class FilePathRef:
+    file_path: str
+    expires_at: float
+
+
+# key: file_unique_id (или file_id) -> FilePathRef. Ссылка от getFile живёт минимум час, кэшируем ненадолго,
+# чтобы повторные обработки той же картинки не делали лишний round-trip в Bot API.
+_FILE_PATHS: OrderedDict[str, FilePathRef] = OrderedDict()
+_FILE_PATH_TTL_S = 60
+_FILE_PATHS_MAX = 1_000
+
+
+@dataclass(frozen=True, slots=True)
+class _CommentJob:
+    bot: Bot
+    channel_chat_id: int
+    channel_message_id: int
+    caption: str
+    expires_at: float
+
+
+# key: (channel_chat_id, channel_message_id) -> _CommentJob. Подписи, для которых автофорвард ещё не пришёл:
+# их ставит в очередь _discussion_map_put, а невостребованные снимает sweeper.
+_PENDING_COMMENTS: OrderedDict[tuple[int, int], _CommentJob] = OrderedDict()
+_PENDING_COMMENTS_MAX = 1_000
+
+_EXPIRY_MAPS: tuple[OrderedDict, ...] = (
+    _DISCUSSION_MAP,
+    _PROCESSED_MEDIA_GROUPS,
+    _PROCESSED_CHANNEL_MESSAGES,
+    _FILE_PATHS,
+    _PENDING_COMMENTS,
+)
+_EXPIRY_MAPS_MAX: tuple[int, ...] = (
+    _DISCUSSION_MAX,
+    _MEDIA_GROUP_MAX,
+    _CHANNEL_MSG_MAX,
+    _FILE_PATHS_MAX,
+    _PENDING_COMMENTS_MAX,
+)
+# В куче остаются записи вытесненных и перезаписанных ключей. Когда она перерастает карты
+# в столько раз, пересобираем её из живых записей — память ограничена и при потоке апдейтов.
+_EXPIRY_HEAP_MAX = 2 * sum(_EXPIRY_MAPS_MAX)
+
+
+@dataclass(frozen=True)
+class _PhotoJob:
+    settings: Settings
+    context: ContextTypes.DEFAULT_TYPE
+    message: Message
+
+
+# Ограниченная очередь постов на обработку: при переполнении новые посты отбрасываются (load shedding).
+_PHOTO_QUEUE: asyncio.Queue[_PhotoJob] = asyncio.Queue(maxsize=100)
+PHOTO_WORKERS = 4
+
+
+# Очередь подписей, для которых уже известен mapping: воркеры только отправляют комментарий.
+_COMMENT_QUEUE: asyncio.Queue[_CommentJob] = asyncio.Queue(maxsize=100)
+COMMENT_WORKERS = 4
+
+# Общий keep-alive клиент для скачивания файлов Telegram (переиспользует TLS-соединения).
+_HTTPX_CLIENT: httpx.AsyncClient | None = None
+
+
+def _expiring_put(map_id: int, key, value, expires_at: float) -> None:
+    """
+    Кладёт запись в карту map_id (с вытеснением давнее всех использованной при переполнении)
+    и регистрирует её срок истечения в общей куче.
+    """
+    m = _EXPIRY_MAPS[map_id]
+    m[key] = value
+    m.move_to_end(key)
+    if len(m) > _EXPIRY_MAPS_MAX[map_id]:
+        m.popitem(last=False)
+    heapq.heappush(_EXPIRY_HEAP, (expires_at, map_id, key))
+    if len(_EXPIRY_HEAP) > _EXPIRY_HEAP_MAX:
+        _rebuild_expiry_heap()
 
 
-def _is_recent(ts: float, ttl_s: float) -> bool:
-    return (time.time() - ts) <= ttl_s
+def _expires_at(value) -> float:
+    # В картах дедупа значение — сам срок истечения, в остальных — dataclass с полем expires_at.
+    return value if isinstance(value, float) else value.expires_at
 
 
-def _mark_processed_channel_message(chat_id: int, message_id: int) -> bool:
+def _rebuild_expiry_heap() -> None:
+    """
+    Пересобирает кучу сроков: по одной записи на каждый живой ключ всех карт.
+    """
+    _EXPIRY_HEAP[:] = [
+        (_expires_at(value), map_id, key)
+        for map_id, m in enumerate(_EXPIRY_MAPS)
+        for key, value in m.items()
+    ]
+    heapq.heapify(_EXPIRY_HEAP)
+
+
+def _mark_processed_channel_message(chat_id: int, message_id: int, now: float) -> bool:
     """
     Возвращает True если сообщение уже обрабатывали (и его надо пропустить),
     иначе помечает как обработанное и возвращает False.
+    now — снимок time.monotonic(), общий для всех проверок одного апдейта.
     """
     key = (chat_id, message_id)
-    ts = _PROCESSED_CHANNEL_MESSAGES.get(key)
-    if ts is not None and _is_recent(ts, _CHANNEL_MSG_TTL_S):
+    expires_at = _PROCESSED_CHANNEL_MESSAGES.get(key)
+    if expires_at is not None and expires_at > now:
+        _PROCESSED_CHANNEL_MESSAGES.move_to_end(key)
         return True
-    _PROCESSED_CHANNEL_MESSAGES[key] = time.time()
+    expires_at = now + _CHANNEL_MSG_TTL_S
+    _expiring_put(_MAP_CHANNEL_MESSAGES, key, expires_at, expires_at)
     return False
 
 
-def _should_skip_media_group(media_group_id: str) -> bool:
-    ts = _PROCESSED_MEDIA_GROUPS.get(media_group_id)
-    if ts is not None and _is_recent(ts, _MEDIA_GROUP_TTL_S):
+def _should_skip_media_group(media_group_id: str, now: float) -> bool:
+    expires_at = _PROCESSED_MEDIA_GROUPS.get(media_group_id)
+    if expires_at is not None and expires_at > now:
+        _PROCESSED_MEDIA_GROUPS.move_to_end(media_group_id)
         return True
-    _PROCESSED_MEDIA_GROUPS[media_group_id] = time.time()
+    expires_at = now + _MEDIA_GROUP_TTL_S
+    _expiring_put(_MAP_MEDIA_GROUPS, media_group_id, expires_at, expires_at)
     return False
 
 
+async def dedup_sweeper_loop() -> None:
+    """
+    Фоновая чистка просроченных записей во всех картах из _EXPIRY_MAPS.
+    """
+    while True:
+        await asyncio.sleep(_DEDUP_SWEEP_INTERVAL_S)
+        now = time.monotonic()
+        while _EXPIRY_HEAP and _EXPIRY_HEAP[0][0] <= now:
+            _, map_id, key = heapq.heappop(_EXPIRY_HEAP)
+            m = _EXPIRY_MAPS[map_id]
+            value = m.get(key)
+            if value is None:
+                continue
+            # Ключ мог быть перезаписан с новым сроком — тогда его снимет более поздняя запись кучи.
+            if _expires_at(value) <= now:
+                m.pop(key, None)
+                if map_id == _MAP_PENDING_COMMENTS:
+                    logger.error(
+                        "Не найдено соответствие поста и сообщения в чате обсуждений (chat_id=%s, message_id=%s). "
+                        "Проверьте: включены комментарии (linked chat), бот добавлен в чат обсуждений "
+                        "и видит автофорварды.",
+                        key[0],
+                        key[1],
+                    )
+
+
+def _get_httpx_client() -> httpx.AsyncClient:
+    global _HTTPX_CLIENT
+    if _HTTPX_CLIENT is None:
+        _HTTPX_CLIENT = httpx.AsyncClient(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=20),
+        )
+    return _HTTPX_CLIENT
+
+
+async def close_httpx_client() -> None:
+    global _HTTPX_CLIENT
+    if _HTTPX_CLIENT is not None:
+        await _HTTPX_CLIENT.aclose()
+        _HTTPX_CLIENT = None
+
+
+class PhotoDownloadError(RuntimeError):
+    """
+    Файл Telegram не скачался. В тексте нет URL: в нём токен бота.
+    """
+
+
+async def download_photo(bot, file_id: str, file_unique_id: str | None = None) -> bytearray:
+    """
+    Скачивает файл Telegram через общий httpx-клиент.
+    file_path из getFile кэшируется по file_unique_id (или по file_id, если он неизвестен),
+    чтобы не повторять getFile.
+    Ошибки HTTP приходят как PhotoDownloadError — без URL, чтобы токен не попал в лог.
+    """
+    cache_key = file_unique_id or file_id
+    now = time.monotonic()
+    ref = _FILE_PATHS.get(cache_key)
+    if ref is not None and ref.expires_at > now:
+        _FILE_PATHS.move_to_end(cache_key)
+        file_path = ref.file_path
+    else:
+        tg_file = await bot.get_file(file_id)
+        file_path = tg_file.file_path
+        if not file_path:
+            raise PhotoDownloadError("Telegram не вернул file_path для файла")
+        expires_at = now + _FILE_PATH_TTL_S
+        _expiring_put(
+            _MAP_FILE_PATHS,
+            cache_key,
+            FilePathRef(file_path=file_path, expires_at=expires_at),
+            expires_at,
+        )
+
+    # file_path — полный URL вида https://api.telegram.org/file/bot<TOKEN>/...; исключения httpx
+    # (HTTPStatusError и др.) включают его в текст, поэтому наружу отдаём только статус/тип ошибки.
+    try:
+        async with _get_httpx_client().stream("GET", file_path) as r:
+            if r.status_code >= 400:
+                raise PhotoDownloadError(f"Telegram file download HTTP {r.status_code}")
+            # Сразу выделяем буфер по content-length и пишем чанки в него, без промежуточной копии bytes.
+            buf = bytearray(int(r.headers.get("content-length") or 0))
+            pos = 0
+            async for chunk in r.aiter_bytes():
+                end = pos + len(chunk)
+                buf[pos:end] = chunk
+                pos = end
+            del buf[pos:]
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        raise PhotoDownloadError(f"Telegram file download failed: {type(e).__name__}") from None
+    return buf
+
+
+# Pool Postgres для handlers (выставляется при старте приложения; None — БД не настроена)
+_DB_POOL: asyncpg.Pool | None = None
+
+# Дата, для которой этот процесс уже запускал чистку старых постов.
+_LAST_POSTS_CLEANUP_DATE: date | None = None
+
+
+def set_db_pool(pool: asyncpg.Pool | None) -> None:
+    global _DB_POOL
+    _DB_POOL = pool
+
+
+# Будильник планировщика опросов (state.poll_kick): новый пост мог сделать опрос публикуемым.
+_POLL_KICK: asyncio.Event | None = None
+
+
+def set_poll_kick(event: asyncio.Event | None) -> None:
+    global _POLL_KICK
+    _POLL_KICK = event
+
+
+def _pick_photo_size(sizes, max_side: int, max_bytes: int = 0):
+    """
+    Выбирает вариант фото для AI: самый большой, у которого обе стороны не больше max_side,
+    а file_size (если Telegram его сообщил) не больше max_bytes.
+    Telegram уже хранит уменьшенные копии, так что качать оригинал (до 2560px) ради
+    vision-модели, которая всё равно его уменьшит, незачем. Ограничение <= 0 не действует.
+    Если по обоим условиям ничего не подошло — самый большой в пределах max_bytes, иначе самый большой.
+    """
+    # PhotoSize в сообщении отсортированы по возрастанию размера.
+    for p in reversed(sizes):
+        if max_side > 0 and max(p.width, p.height) > max_side:
+            continue
+        if max_bytes > 0 and p.file_size and p.file_size > max_bytes:
+            continue
+        return p
+    if max_bytes > 0:
+        for p in reversed(sizes):
+            if not p.file_size or p.file_size <= max_bytes:
+                return p
+    return sizes[-1]
+
+
+@lru_cache(maxsize=8)
+def _tz(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
+
+
 async def _record_post_for_poll_if_needed(
-    context: ContextTypes.DEFAULT_TYPE,
+    settings: Settings,
     channel_id: int,
     message_id: int,
     post_date,
     photo_file_id: str | None,
-) -> None:
-    settings = get_settings()
-    pool = getattr(getattr(context, "application", None), "bot_data", {}).get("db_pool")
-    if pool is None:
-        return
+) -> bool:
+    """
+    Возвращает False, если пост уже был записан в БД раньше (например, до рестарта процесса).
+    """
+    global _LAST_POSTS_CLEANUP_DATE
 
-    # Записываем посты для статистики всегда, если есть БД
-    await maybe_cleanup_old_posts(pool, post_date, days=30)
-    await record_post(pool, channel_id, message_id, post_date, photo_file_id)
+    pool = _DB_POOL
+    if pool is None:
+        return True
 
-    # Планируем опрос только для строго заданных каналов и при включённом режиме
-    if not settings.daily_poll_enabled:
-        return
     poll_channels = settings.daily_poll_channel_ids
-    if not poll_channels or channel_id not in poll_channels:
-        return
 
-    # Планируем poll на сегодня, если ещё не создан
-    await _ensure_poll_scheduled(pool, channel_id, post_date)
+    # Все запросы поста выполняем на одном соединении, а не берём его из пула на каждый запрос.
+    async with pool.acquire() as conn:
+        # Чистка старых постов нужна только при первом посте нового дня и идёт тем же запросом,
+        # что и вставка; дальше в этот день процесс её не запрашивает.
+        cleanup_days = 30 if _LAST_POSTS_CLEANUP_DATE != post_date else None
 
+        # Записываем посты для статистики всегда, если есть БД
+        inserted = await record_post(conn, channel_id, message_id, post_date, photo_file_id, cleanup_days=cleanup_days)
+        # Дату отмечаем только после успешного запроса: при ошибке чистку попробует следующий пост.
+        if cleanup_days is not None:
+            _LAST_POSTS_CLEANUP_DATE = post_date
 
-async def _ensure_poll_scheduled(pool, channel_id: int, poll_date) -> None:
-    settings = get_settings()
-    from datetime import datetime, time as dtime
-    from zoneinfo import ZoneInfo
-    import random
+        # Планируем опрос только для строго заданных каналов и при включённом режиме.
+        if settings.daily_poll_enabled and poll_channels and channel_id in poll_channels:
+            await _ensure_poll_scheduled(settings, conn, channel_id, post_date)
+            if inserted and _POLL_KICK is not None:
+                _POLL_KICK.set()
 
-    tz = ZoneInfo(settings.daily_poll_timezone)
+    return inserted
+
+
+async def _ensure_poll_scheduled(settings: Settings, conn, channel_id: int, poll_date) -> None:
+    tz = _tz(settings.daily_poll_timezone)
     start = dtime(hour=settings.daily_poll_start_hour, minute=0)
     end = dtime(hour=settings.daily_poll_end_hour, minute=0)
 
@@ -115,22 +390,36 @@ async def _ensure_poll_scheduled(pool, channel_id: int, poll_date) -> None:
     scheduled_local = start_dt + timedelta(seconds=offset)
     scheduled_utc = scheduled_local.astimezone(timezone.utc)
 
-    await ensure_daily_poll(pool, channel_id, poll_date, scheduled_utc)
+    await ensure_daily_poll(conn, channel_id, poll_date, scheduled_utc)
 
 
-def _discussion_map_put(channel_chat_id: int, channel_message_id: int, discussion_chat_id: int, discussion_message_id: int) -> None:
-    _DISCUSSION_MAP[(channel_chat_id, channel_message_id)] = DiscussionRef(
+def _discussion_map_put(
+    channel_chat_id: int,
+    channel_message_id: int,
+    discussion_chat_id: int,
+    discussion_message_id: int,
+    now: float,
+) -> None:
+    key = (channel_chat_id, channel_message_id)
+    expires_at = now + _DISCUSSION_TTL_S
+    ref = DiscussionRef(
         discussion_chat_id=discussion_chat_id,
         discussion_message_id=discussion_message_id,
-        ts=time.time(),
+        expires_at=expires_at,
     )
+    _expiring_put(_MAP_DISCUSSION, key, ref, expires_at)
 
+    # Подпись, ждавшая mapping этого поста, уходит на отправку.
+    job = _PENDING_COMMENTS.pop(key, None)
+    if job is not None:
+        _enqueue_comment(job)
 
-def _discussion_map_get(channel_chat_id: int, channel_message_id: int) -> DiscussionRef | None:
+
+def _discussion_map_get(channel_chat_id: int, channel_message_id: int, now: float) -> DiscussionRef | None:
     ref = _DISCUSSION_MAP.get((channel_chat_id, channel_message_id))
     if ref is None:
         return None
-    if time.time() - ref.ts > _DISCUSSION_TTL_S:
+    if ref.expires_at <= now:
         _DISCUSSION_MAP.pop((channel_chat_id, channel_message_id), None)
         return None
     return ref
@@ -142,19 +431,17 @@ def _extract_origin_channel_and_msg_id(message) -> tuple[int, int] | None:
     Поддерживаем разные версии Bot API / PTB: forward_from_chat + forward_from_message_id или forward_origin.
     """
     # legacy fields
-    fchat = getattr(message, "forward_from_chat", None)
-    fmid = getattr(message, "forward_from_message_id", None)
-    if fchat is not None and isinstance(getattr(fchat, "id", None), int) and isinstance(fmid, int):
-        return int(fchat.id), int(fmid)
+    try:
+        return int(message.forward_from_chat.id), int(message.forward_from_message_id)
+    except (AttributeError, TypeError):
+        pass
 
     # newer: forward_origin (MessageOriginChannel)
-    origin = getattr(message, "forward_origin", None)
-    if origin is not None:
-        ochat = getattr(origin, "chat", None)
-        omid = getattr(origin, "message_id", None)
-        if ochat is not None and isinstance(getattr(ochat, "id", None), int) and isinstance(omid, int):
-            return int(ochat.id), int(omid)
-    return None
+    try:
+        origin = message.forward_origin
+        return int(origin.chat.id), int(origin.message_id)
+    except (AttributeError, TypeError):
+        return None
 
 
 async def handle_discussion_auto_forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -180,18 +467,20 @@ async def handle_discussion_auto_forward(update: Update, context: ContextTypes.D
         channel_message_id=channel_message_id,
         discussion_chat_id=msg.chat.id,
         discussion_message_id=msg.message_id,
+        now=time.monotonic(),
     )
 
-    pool = getattr(getattr(context, "application", None), "bot_data", {}).get("db_pool")
+    pool = _DB_POOL
     if pool is not None:
         try:
-            await update_discussion_mapping(
-                pool=pool,
-                channel_id=channel_chat_id,
-                message_id=channel_message_id,
-                discussion_chat_id=msg.chat.id,
-                discussion_message_id=msg.message_id,
-            )
+            async with pool.acquire() as conn:
+                await update_discussion_mapping(
+                    conn=conn,
+                    channel_id=channel_chat_id,
+                    message_id=channel_message_id,
+                    discussion_chat_id=msg.chat.id,
+                    discussion_message_id=msg.message_id,
+                )
         except Exception:
             logger.exception("Не удалось сохранить mapping поста и discussion message в БД")
 
@@ -210,28 +499,54 @@ async def handle_channel_photo_post(update: Update, context: ContextTypes.DEFAUL
     if not msg.photo:
         return
 
+    # Один снимок часов на все TTL-проверки апдейта.
+    now = time.monotonic()
+
     # Не отвечаем несколько раз на один и тот же пост (на случай дублей апдейтов)
-    if _mark_processed_channel_message(msg.chat.id, msg.message_id):
+    if _mark_processed_channel_message(msg.chat.id, msg.message_id, now):
         return
 
     # Если это альбом (несколько картинок = media_group_id), отвечаем только один раз — на первую пришедшую картинку.
     media_group_id = getattr(msg, "media_group_id", None)
     if isinstance(media_group_id, str) and media_group_id:
-        if _should_skip_media_group(media_group_id):
+        if _should_skip_media_group(media_group_id, now):
             return
 
-    # Берём самое большое фото
-    photo = msg.photo[-1]
+    # Тяжёлую часть (БД, скачивание, AI, отправка) делают воркеры, чтобы webhook отвечал сразу.
+    try:
+        _PHOTO_QUEUE.put_nowait(_PhotoJob(settings=settings, context=context, message=msg))
+    except asyncio.QueueFull:
+        logger.warning(
+            "Очередь обработки постов переполнена, пост пропущен (chat_id=%s, message_id=%s)",
+            msg.chat.id,
+            msg.message_id,
+        )
+
+
+async def photo_worker_loop() -> None:
+    """
+    Воркер очереди постов канала с картинками.
+    """
+    while True:
+        job = await _PHOTO_QUEUE.get()
+        try:
+            await _process_photo_post(job.settings, job.context, job.message)
+        except Exception:
+            logger.exception("Ошибка обработки поста канала")
+        finally:
+            _PHOTO_QUEUE.task_done()
+
+
+async def _process_photo_post(settings: Settings, context: ContextTypes.DEFAULT_TYPE, msg: Message) -> None:
+    photo = _pick_photo_size(msg.photo, settings.timeweb_ai_photo_max_side, settings.timeweb_ai_max_image_bytes)
     photo_file_id = photo.file_id
 
     # Запись в БД (для режима дневных опросов/статистики)
     try:
-        from zoneinfo import ZoneInfo
-
-        tz = ZoneInfo(settings.daily_poll_timezone)
+        tz = _tz(settings.daily_poll_timezone)
         post_date = (msg.date.astimezone(tz) if msg.date else datetime.now(tz)).date()
-        await _record_post_for_poll_if_needed(
-            context=context,
+        is_new_post = await _record_post_for_poll_if_needed(
+            settings=settings,
             channel_id=msg.chat.id,
             message_id=msg.message_id,
             post_date=post_date,
@@ -239,9 +554,17 @@ async def handle_channel_photo_post(update: Update, context: ContextTypes.DEFAUL
         )
     except Exception:
         logger.exception("Не удалось записать пост в БД для режима опросов")
+    else:
+        # In-memory дедуп теряется при рестарте; БД помнит, что пост уже обрабатывался.
+        if not is_new_post:
+            logger.info(
+                "Пост уже был обработан ранее, пропускаем (chat_id=%s, message_id=%s)",
+                msg.chat.id,
+                msg.message_id,
+            )
+            return
 
-    tg_file = await context.bot.get_file(photo_file_id)
-    image_bytes = bytes(await tg_file.download_as_bytearray())
+    image_bytes = await download_photo(context.bot, photo_file_id, photo.file_unique_id)
 
     original_caption = msg.caption
 
@@ -251,29 +574,76 @@ async def handle_channel_photo_post(update: Update, context: ContextTypes.DEFAUL
         logger.exception("Не удалось сгенерировать подпись через Timeweb AI")
         return
 
-    async def _try_send_comment_with_retries() -> None:
-        # Пытаемся дождаться, пока в linked-чате появится автофорвард (mapping).
-        delays = [0.5, 1, 2, 4, 8, 12]
-        for d in delays:
-            ref = _discussion_map_get(msg.chat.id, msg.message_id)
-            if ref is not None:
-                try:
-                    await context.bot.send_message(
-                        chat_id=ref.discussion_chat_id,
-                        text=caption,
-                        reply_to_message_id=ref.discussion_message_id,
-                        allow_sending_without_reply=True,
-                    )
-                except Exception:
-                    logger.exception("Не удалось отправить комментарий в чат обсуждений")
-                return
-            await asyncio.sleep(d)
+    # Комментарий отправляет воркер, чтобы не задерживать обработку следующих постов.
+    # Пока автофорварда нет, подпись ждёт его в _PENDING_COMMENTS, не занимая воркер.
+    now = time.monotonic()
+    job = _CommentJob(
+        bot=context.bot,
+        channel_chat_id=msg.chat.id,
+        channel_message_id=msg.message_id,
+        caption=caption,
+        expires_at=now + _DISCUSSION_WAIT_TIMEOUT_S,
+    )
+    if _discussion_map_get(msg.chat.id, msg.message_id, now) is not None:
+        _enqueue_comment(job)
+    else:
+        _expiring_put(_MAP_PENDING_COMMENTS, (msg.chat.id, msg.message_id), job, job.expires_at)
+
+
+def _enqueue_comment(job: _CommentJob) -> None:
+    try:
+        _COMMENT_QUEUE.put_nowait(job)
+    except asyncio.QueueFull:
+        logger.warning(
+            "Очередь комментариев переполнена, комментарий пропущен (chat_id=%s, message_id=%s)",
+            job.channel_chat_id,
+            job.channel_message_id,
+        )
+
+
+async def drain_work_queues(timeout_s: float) -> None:
+    """
+    Ждёт, пока воркеры разберут очереди постов и комментариев (каждую не дольше timeout_s).
+    """
+    for name, queue in (("постов", _PHOTO_QUEUE), ("комментариев", _COMMENT_QUEUE)):
+        try:
+            await asyncio.wait_for(queue.join(), timeout=timeout_s)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь %s не разобрана до остановки, осталось %s задач", name, queue.qsize())
+
+
+async def comment_worker_loop() -> None:
+    """
+    Воркер очереди комментариев в чат обсуждений.
+    """
+    while True:
+        job = await _COMMENT_QUEUE.get()
+        try:
+            await _send_comment(job)
+        except Exception:
+            logger.exception("Ошибка отправки комментария")
+        finally:
+            _COMMENT_QUEUE.task_done()
+
 
+async def _send_comment(job: _CommentJob) -> None:
+    # В очередь попадают только посты с mapping, но он мог истечь, пока задача ждала воркер.
+    ref = _discussion_map_get(job.channel_chat_id, job.channel_message_id, time.monotonic())
+    if ref is None:
         logger.error(
-            "Не найдено соответствие поста и сообщения в чате обсуждений. "
-            "Проверьте: включены комментарии (linked chat), бот добавлен в чат обсуждений и видит автофорварды."
+            "Не найдено соответствие поста и сообщения в чате обсуждений (chat_id=%s, message_id=%s)",
+            job.channel_chat_id,
+            job.channel_message_id,
         )
+        return
 
-    # Фоном, чтобы не задерживать обработку webhook
-    asyncio.create_task(_try_send_comment_with_retries())
+    try:
+        await job.bot.send_message(
+            chat_id=ref.discussion_chat_id,
+            text=job.caption,
+            reply_to_message_id=ref.discussion_message_id,
+            allow_sending_without_reply=True,
+        )
+    except Exception:
+        logger.exception("Не удалось отправить комментарий в чат обсуждений")
 
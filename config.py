@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from functools import lru_cache
+import re
+from functools import cached_property, lru_cache
 
 from pydantic import Field
 from pydantic import field_validator
@@ -8,6 +9,10 @@ from pydantic import ValidationError
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+# Разделители в списках ID каналов: запятая, точка с запятой, пробелы и переводы строк.
+_ID_LIST_SEP = re.compile(r"[,;\s]+")
+
+
 class Settings(BaseSettings):
     """
     Конфигурация через переменные окружения.
@@ -38,6 +43,11 @@ class Settings(BaseSettings):
     database_user: str | None = Field(None, alias="DATABASE_USER")
     database_password: str | None = Field(None, alias="DATABASE_PASSWORD")
     database_port: int = Field(5432, alias="DATABASE_PORT")
+    # Размер пула соединений (подбирается под max_connections в Postgres)
+    database_pool_min: int = Field(5, alias="DATABASE_POOL_MIN")
+    database_pool_max: int = Field(20, alias="DATABASE_POOL_MAX")
+    # Кэш подготовленных запросов на соединение; 0 — для PgBouncer в transaction mode
+    database_statement_cache_size: int = Field(256, alias="DATABASE_STATEMENT_CACHE_SIZE")
 
     # Timeweb AI / OpenAI-совместимый API
     timeweb_ai_base_url: str = Field("https://api.timeweb.cloud", alias="TIMEWEB_AI_BASE_URL")
@@ -50,6 +60,12 @@ class Settings(BaseSettings):
     timeweb_ai_max_completion_tokens: int = Field(256, alias="TIMEWEB_AI_MAX_COMPLETION_TOKENS")
     timeweb_ai_use_post_caption: bool = Field(True, alias="TIMEWEB_AI_USE_POST_CAPTION")
     timeweb_ai_emoji_ratio: float = Field(0.3, alias="TIMEWEB_AI_EMOJI_RATIO")
+    # Максимальная сторона картинки, которую качаем для AI (0 — оригинал)
+    timeweb_ai_photo_max_side: int = Field(1280, alias="TIMEWEB_AI_PHOTO_MAX_SIDE")
+    # Максимальный размер картинки для AI в байтах (0 — без ограничения)
+    timeweb_ai_max_image_bytes: int = Field(5 * 1024 * 1024, alias="TIMEWEB_AI_MAX_IMAGE_BYTES")
+    # Сжимать тело запроса (Content-Encoding: gzip) — только если endpoint это поддерживает
+    timeweb_ai_gzip_requests: bool = Field(False, alias="TIMEWEB_AI_GZIP_REQUESTS")
 
     # Daily poll settings
     daily_poll_enabled: bool = Field(False, alias="DAILY_POLL_ENABLED")
@@ -103,20 +119,20 @@ class Settings(BaseSettings):
             f"@{self.database_host}:{self.database_port}/{self.database_name}"
         )
 
-    @property
-    def allowed_channel_ids(self) -> set[int] | None:
+    @cached_property
+    def allowed_channel_ids(self) -> frozenset[int] | None:
         """
         Список разрешённых каналов (опционально).
         Поддерживает TELEGRAM_ALLOWED_CHANNEL_ID и TELEGRAM_ALLOWED_CHANNEL_IDS (через запятую/пробел).
+        Вычисляется один раз: проверяется на каждом апдейте канала.
         """
         ids: set[int] = set()
         if self.allowed_channel_id is not None:
             ids.add(int(self.allowed_channel_id))
 
         if self.allowed_channel_ids_raw:
-            parts = self.allowed_channel_ids_raw.replace(";", ",").replace("\n", ",").split(",")
+            parts = _ID_LIST_SEP.split(self.allowed_channel_ids_raw.strip())
             for p in parts:
-                p = p.strip()
                 if not p:
                     continue
                 try:
@@ -124,30 +140,32 @@ class Settings(BaseSettings):
                 except ValueError:
                     continue
 
-        return ids if ids else None
+        return frozenset(ids) if ids else None
 
-    @property
-    def daily_poll_channel_ids(self) -> set[int] | None:
+    @cached_property
+    def daily_poll_channel_ids(self) -> frozenset[int] | None:
+        """
+        Строгий список каналов для опросов. Вычисляется один раз: проверяется на каждом посте и тике poller'а.
+        """
         if not self.daily_poll_channel_ids_raw:
             return None
         ids: set[int] = set()
-        parts = self.daily_poll_channel_ids_raw.replace(";", ",").replace("\n", ",").split(",")
+        parts = _ID_LIST_SEP.split(self.daily_poll_channel_ids_raw.strip())
         for p in parts:
-            p = p.strip()
             if not p:
                 continue
             try:
                 ids.add(int(p))
             except ValueError:
                 continue
-        return ids if ids else None
+        return frozenset(ids) if ids else None
 
     @property
     def daily_poll_questions(self) -> list[str]:
         return [q.strip() for q in self.daily_poll_questions_raw.split("|") if q.strip()]
 
 
-@lru_cache
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
     return Settings()
 
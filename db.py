@@ -1,11 +1,12 @@
 from __future__ import annotations
 
-import json
+import functools
 from datetime import date, datetime, timezone
 from typing import Any
 
 import asyncpg
 import logging
+import orjson
 
 
 logger = logging.getLogger(__name__)
@@ -50,13 +51,55 @@ ALTER TABLE daily_poll
     ADD COLUMN IF NOT EXISTS last_error TEXT;
 ALTER TABLE daily_poll
     ADD COLUMN IF NOT EXISTS last_error_at TIMESTAMPTZ;
+
+-- Только ожидающие опросы: под условие get_due_polls, индекс остаётся крошечным.
+CREATE INDEX IF NOT EXISTS idx_daily_poll_due
+    ON daily_poll(scheduled_at)
+    WHERE posted_at IS NULL AND skipped_at IS NULL;
 """
 
 
-async def create_pool(dsn: str) -> asyncpg.Pool:
-    pool = await asyncpg.create_pool(dsn=dsn, min_size=1, max_size=5)
-    async with pool.acquire() as conn:
+async def _init_connection(conn: _BotConnection, prepare: bool) -> None:
+    # jsonb в бинарном протоколе: байт версии (1) + JSON-текст; (де)сериализуем через orjson.
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=lambda v: b"\x01" + orjson.dumps(v),
+        decoder=lambda b: orjson.loads(b[1:]),
+        schema="pg_catalog",
+        format="binary",
+    )
+    # Готовим запросы горячего пути один раз на соединение. За PgBouncer (transaction mode)
+    # подготовленные запросы не переживают смену серверного соединения — там не готовим.
+    conn.prepared = {sql: await conn.prepare(sql) for sql in _PREPARED_SQL} if prepare else {}
+
+
+async def create_pool(
+    dsn: str,
+    min_size: int = 5,
+    max_size: int = 20,
+    statement_cache_size: int = 256,
+) -> asyncpg.Pool:
+    # Схему создаём до пула: соединения пула при создании готовят запросы к этим таблицам.
+    conn = await asyncpg.connect(dsn=dsn)
+    try:
         await conn.execute(SCHEMA_SQL)
+    finally:
+        await conn.close()
+
+    # min_size держим «тёплым», чтобы первый апдейт после простоя не ждал установки соединения.
+    pool = await asyncpg.create_pool(
+        dsn=dsn,
+        min_size=min_size,
+        max_size=max(min_size, max_size),
+        max_inactive_connection_lifetime=300,
+        command_timeout=10,
+        init=functools.partial(_init_connection, prepare=statement_cache_size > 0),
+        connection_class=_BotConnection,
+        # Все запросы бота — фиксированные строки: планы живут весь срок соединения.
+        statement_cache_size=statement_cache_size,
+        max_cached_statement_lifetime=0,
+        max_cacheable_statement_size=15 * 1024,
+    )
     logger.info("Postgres connected and schema ensured")
     return pool
 
@@ -65,165 +108,250 @@ async def close_pool(pool: asyncpg.Pool) -> None:
     await pool.close()
 
 
-async def maybe_cleanup_old_posts(pool: asyncpg.Pool, today: date, days: int = 30) -> None:
+_UPDATE_DISCUSSION_SQL = """
+UPDATE posts
+SET discussion_chat_id = $3,
+    discussion_message_id = $4
+WHERE channel_id = $1 AND message_id = $2
+"""
+
+_ENSURE_DAILY_POLL_SQL = """
+INSERT INTO daily_poll(channel_id, poll_date, scheduled_at)
+SELECT $1::bigint, $2::date, $3::timestamptz
+WHERE NOT EXISTS (SELECT 1 FROM daily_poll WHERE channel_id = $1 AND poll_date = $2)
+ON CONFLICT (channel_id, poll_date) DO NOTHING
+"""
+
+_DUE_POLLS_SQL = """
+SELECT channel_id, poll_date FROM daily_poll
+WHERE posted_at IS NULL
+  AND skipped_at IS NULL
+  AND scheduled_at <= $1
+  AND channel_id = ANY($2::bigint[])
+"""
+
+# Ближайший ещё не обработанный опрос (по частичному индексу idx_daily_poll_due).
+_NEXT_DUE_AT_SQL = """
+SELECT MIN(scheduled_at) FROM daily_poll
+WHERE posted_at IS NULL
+  AND skipped_at IS NULL
+  AND channel_id = ANY($1::bigint[])
+"""
+
+_COUNT_AND_PICK_SQL = """
+WITH c AS (
+    SELECT COUNT(*) AS n FROM posts WHERE channel_id = $1 AND post_date = $2
+)
+SELECT c.n AS posts_count, p.message_id, p.photo_file_id
+FROM c
+LEFT JOIN LATERAL (
+    SELECT message_id, photo_file_id
+    FROM posts
+    WHERE channel_id = $1 AND post_date = $2
+    OFFSET floor(random() * (SELECT n FROM c))::int
+    LIMIT 1
+) p ON true
+"""
+
+# Дубль (повтор апдейта) отсекается проверкой по уникальному индексу до вставки:
+# без попытки INSERT не тратится значение sequence id. ON CONFLICT остаётся на случай гонки.
+_INSERT_POST_SQL = """
+INSERT INTO posts(channel_id, message_id, post_date, photo_file_id)
+SELECT $1::bigint, $2::bigint, $3::date, $4::text
+WHERE NOT EXISTS (SELECT 1 FROM posts WHERE channel_id = $1 AND message_id = $2)
+ON CONFLICT (channel_id, message_id) DO NOTHING
+"""
+# Чистка старых постов тем же запросом (data-modifying CTE), при первом посте нового дня.
+_INSERT_POST_WITH_CLEANUP_SQL = """
+WITH cleanup AS (
+    DELETE FROM posts
+    WHERE created_at < (NOW() - make_interval(days => $5))
+      AND NOT EXISTS (SELECT 1 FROM posts WHERE post_date = $3)
+)
+""" + _INSERT_POST_SQL
+
+
+# Запросы горячего пути, которые готовятся на каждом соединении при его создании.
+_PREPARED_SQL = (
+    _INSERT_POST_SQL,
+    _UPDATE_DISCUSSION_SQL,
+    _ENSURE_DAILY_POLL_SQL,
+    _DUE_POLLS_SQL,
+    _NEXT_DUE_AT_SQL,
+    _COUNT_AND_PICK_SQL,
+)
+
+
+class _BotConnection(asyncpg.Connection):
     """
-    Очистка старых постов при первом посте нового дня (глобально).
-    Если в БД уже есть посты за today — чистку не делаем.
+    Соединение пула с подготовленными запросами (SQL-текст -> PreparedStatement).
     """
-    async with pool.acquire() as conn:
-        exists = await conn.fetchval(
-            "SELECT 1 FROM posts WHERE post_date = $1 LIMIT 1",
-            today,
-        )
-        if exists:
-            return
-        await conn.execute(
-            "DELETE FROM posts WHERE created_at < (NOW() - make_interval(days => $1))",
-            int(days),
-        )
+
+    __slots__ = ("prepared",)
+
+
+def _prepared(conn: asyncpg.Connection, sql: str) -> asyncpg.prepared_stmt.PreparedStatement | None:
+    # Соединения не из пула бота (или без подготовки, PgBouncer) просто выполняют SQL-текст.
+    prepared = getattr(conn, "prepared", None)
+    return prepared.get(sql) if prepared else None
+
+
+async def _execute(conn: asyncpg.Connection, sql: str, *args) -> str:
+    stmt = _prepared(conn, sql)
+    if stmt is None:
+        return await conn.execute(sql, *args)
+    await stmt.fetch(*args)
+    return stmt.get_statusmsg()
 
 
 async def record_post(
-    pool: asyncpg.Pool,
+    conn: asyncpg.Connection,
     channel_id: int,
     message_id: int,
     post_date: date,
     photo_file_id: str | None,
-) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO posts(channel_id, message_id, post_date, photo_file_id)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (channel_id, message_id) DO NOTHING
-            """,
+    cleanup_days: int | None = None,
+) -> bool:
+    """
+    Возвращает True, если пост записан впервые (False — такая строка уже была).
+    Если задан cleanup_days — тем же запросом чистит посты старше cleanup_days дней
+    (глобально, только если в БД ещё нет постов за post_date, т.е. при первом посте нового дня).
+    """
+    if cleanup_days is None:
+        status = await _execute(
+            conn,
+            _INSERT_POST_SQL,
             channel_id,
             message_id,
             post_date,
             photo_file_id,
         )
+    else:
+        status = await conn.execute(
+            _INSERT_POST_WITH_CLEANUP_SQL,
+            channel_id,
+            message_id,
+            post_date,
+            photo_file_id,
+            int(cleanup_days),
+        )
+    # asyncpg возвращает статус вида "INSERT 0 <rows>"
+    return status.endswith(" 1")
 
 
 async def update_discussion_mapping(
-    pool: asyncpg.Pool,
+    conn: asyncpg.Connection,
     channel_id: int,
     message_id: int,
     discussion_chat_id: int,
     discussion_message_id: int,
 ) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            UPDATE posts
-            SET discussion_chat_id = $3,
-                discussion_message_id = $4
-            WHERE channel_id = $1 AND message_id = $2
-            """,
-            channel_id,
-            message_id,
-            discussion_chat_id,
-            discussion_message_id,
-        )
+    await _execute(
+        conn,
+        _UPDATE_DISCUSSION_SQL,
+        channel_id,
+        message_id,
+        discussion_chat_id,
+        discussion_message_id,
+    )
 
 
 async def get_post(
-    pool: asyncpg.Pool,
+    conn: asyncpg.Connection,
     channel_id: int,
     message_id: int,
 ) -> asyncpg.Record | None:
-    async with pool.acquire() as conn:
-        return await conn.fetchrow(
-            """
-            SELECT channel_id, message_id, photo_file_id, discussion_chat_id, discussion_message_id
-            FROM posts
-            WHERE channel_id = $1 AND message_id = $2
-            """,
-            channel_id,
-            message_id,
-        )
-
-async def ensure_daily_poll(pool: asyncpg.Pool, channel_id: int, poll_date: date, scheduled_at: datetime) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO daily_poll(channel_id, poll_date, scheduled_at)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (channel_id, poll_date) DO NOTHING
-            """,
-            channel_id,
-            poll_date,
-            scheduled_at,
-        )
-
-
-async def force_schedule_daily_poll(
-    pool: asyncpg.Pool,
-    channel_id: int,
+    return await conn.fetchrow(
+        """
+        SELECT channel_id, message_id, photo_file_id, discussion_chat_id, discussion_message_id
+        FROM posts
+        WHERE channel_id = $1 AND message_id = $2
+        """,
+        channel_id,
+        message_id,
+    )
+
+async def ensure_daily_poll(conn: asyncpg.Connection, channel_id: int, poll_date: date, scheduled_at: datetime) -> None:
+    await _execute(
+        conn,
+        _ENSURE_DAILY_POLL_SQL,
+        channel_id,
+        poll_date,
+        scheduled_at,
+    )
+
+
+async def force_schedule_daily_polls(
+    conn: asyncpg.Connection,
+    channel_ids: list[int],
     poll_date: date,
     scheduled_at: datetime,
 ) -> None:
     """
-    Принудительно ставит опрос на "сейчас" (даже если запись уже есть).
-    Сбрасывает posted_at/skipped_at/last_error.
+    Принудительно ставит опросы каналов на "сейчас" (даже если записи уже есть).
+    Сбрасывает posted_at/skipped_at/last_error. Все каналы — одним executemany.
     """
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO daily_poll(channel_id, poll_date, scheduled_at, posted_at, skipped_at, last_error, last_error_at)
-            VALUES ($1, $2, $3, NULL, NULL, NULL, NULL)
-            ON CONFLICT (channel_id, poll_date)
-            DO UPDATE SET
-                scheduled_at = EXCLUDED.scheduled_at,
-                posted_at = NULL,
-                skipped_at = NULL,
-                last_error = NULL,
-                last_error_at = NULL
-            """,
-            channel_id,
-            poll_date,
-            scheduled_at,
-        )
-
-
-async def get_due_polls(pool: asyncpg.Pool, now_utc: datetime) -> list[asyncpg.Record]:
-    async with pool.acquire() as conn:
-        return await conn.fetch(
-            """
-            SELECT * FROM daily_poll
-            WHERE posted_at IS NULL
-              AND skipped_at IS NULL
-              AND scheduled_at <= $1
-            """,
-            now_utc,
-        )
+    await conn.executemany(
+        """
+        INSERT INTO daily_poll(channel_id, poll_date, scheduled_at, posted_at, skipped_at, last_error, last_error_at)
+        VALUES ($1, $2, $3, NULL, NULL, NULL, NULL)
+        ON CONFLICT (channel_id, poll_date)
+        DO UPDATE SET
+            scheduled_at = EXCLUDED.scheduled_at,
+            posted_at = NULL,
+            skipped_at = NULL,
+            last_error = NULL,
+            last_error_at = NULL
+        """,
+        [(channel_id, poll_date, scheduled_at) for channel_id in channel_ids],
+    )
+
+
+async def get_due_polls(
+    conn: asyncpg.Connection,
+    now_utc: datetime,
+    channel_ids: list[int],
+) -> list[asyncpg.Record]:
+    """
+    Опросы, время которых наступило, только для переданных каналов (фильтр на стороне БД).
+    """
+    stmt = _prepared(conn, _DUE_POLLS_SQL)
+    if stmt is not None:
+        return await stmt.fetch(now_utc, channel_ids)
+    return await conn.fetch(_DUE_POLLS_SQL, now_utc, channel_ids)
 
 
-async def count_posts_for_date(pool: asyncpg.Pool, channel_id: int, poll_date: date) -> int:
-    async with pool.acquire() as conn:
-        return await conn.fetchval(
-            "SELECT COUNT(*) FROM posts WHERE channel_id = $1 AND post_date = $2",
-            channel_id,
-            poll_date,
-        )
+async def next_due_at(conn: asyncpg.Connection, channel_ids: list[int]) -> datetime | None:
+    """
+    Ближайший scheduled_at среди переданных каналов — тот же фильтр, что в get_due_polls,
+    иначе опрос канала вне списка навсегда остался бы «просроченным».
+    """
+    stmt = _prepared(conn, _NEXT_DUE_AT_SQL)
+    if stmt is not None:
+        return await stmt.fetchval(channel_ids)
+    return await conn.fetchval(_NEXT_DUE_AT_SQL, channel_ids)
 
 
-async def pick_random_post(pool: asyncpg.Pool, channel_id: int, poll_date: date) -> asyncpg.Record | None:
-    async with pool.acquire() as conn:
-        return await conn.fetchrow(
-            """
-            SELECT message_id, photo_file_id
-            FROM posts
-            WHERE channel_id = $1 AND post_date = $2
-            ORDER BY RANDOM()
-            LIMIT 1
-            """,
-            channel_id,
-            poll_date,
-        )
+async def count_and_pick_random_post(
+    conn: asyncpg.Connection,
+    channel_id: int,
+    poll_date: date,
+) -> tuple[int, asyncpg.Record | None]:
+    """
+    Количество постов за день и случайный из них — одним запросом.
+    Случайный пост выбирается смещением по количеству (без ORDER BY RANDOM()).
+    """
+    stmt = _prepared(conn, _COUNT_AND_PICK_SQL)
+    if stmt is not None:
+        row = await stmt.fetchrow(channel_id, poll_date)
+    else:
+        row = await conn.fetchrow(_COUNT_AND_PICK_SQL, channel_id, poll_date)
+    post = row if row["message_id"] is not None else None
+    return int(row["posts_count"]), post
 
 
 async def mark_poll_posted(
-    pool: asyncpg.Pool,
+    conn: asyncpg.Connection,
     channel_id: int,
     poll_date: date,
     poll_message_id: int,
@@ -231,57 +359,58 @@ async def mark_poll_posted(
     question: str,
     options: list[str],
 ) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            UPDATE daily_poll
-            SET posted_at = NOW(),
-                poll_message_id = $3,
-                chosen_post_message_id = $4,
-                question = $5,
-                options = $6::jsonb
-            WHERE channel_id = $1 AND poll_date = $2
-            """,
-            channel_id,
-            poll_date,
-            poll_message_id,
-            chosen_post_message_id,
-            question,
-            json.dumps(options, ensure_ascii=False),
-        )
-
-
-async def mark_poll_skipped(pool: asyncpg.Pool, channel_id: int, poll_date: date) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            UPDATE daily_poll
-            SET skipped_at = NOW()
-            WHERE channel_id = $1 AND poll_date = $2
-            """,
-            channel_id,
-            poll_date,
-        )
-
-
-async def mark_poll_error(
-    pool: asyncpg.Pool,
+    await conn.execute(
+        """
+        UPDATE daily_poll
+        SET posted_at = NOW(),
+            poll_message_id = $3,
+            chosen_post_message_id = $4,
+            question = $5,
+            options = $6
+        WHERE channel_id = $1 AND poll_date = $2
+        """,
+        channel_id,
+        poll_date,
+        poll_message_id,
+        chosen_post_message_id,
+        question,
+        options,
+    )
+
+
+async def mark_poll_skipped(conn: asyncpg.Connection, channel_id: int, poll_date: date) -> None:
+    await conn.execute(
+        """
+        UPDATE daily_poll
+        SET skipped_at = NOW()
+        WHERE channel_id = $1 AND poll_date = $2
+        """,
+        channel_id,
+        poll_date,
+    )
+
+
+async def mark_poll_failed(
+    conn: asyncpg.Connection,
     channel_id: int,
     poll_date: date,
     error_text: str,
 ) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            UPDATE daily_poll
-            SET last_error = $3,
-                last_error_at = NOW()
-            WHERE channel_id = $1 AND poll_date = $2
-            """,
-            channel_id,
-            poll_date,
-            error_text,
-        )
+    """
+    Ошибка и пропуск опроса — одним UPDATE.
+    """
+    await conn.execute(
+        """
+        UPDATE daily_poll
+        SET last_error = $3,
+            last_error_at = NOW(),
+            skipped_at = NOW()
+        WHERE channel_id = $1 AND poll_date = $2
+        """,
+        channel_id,
+        poll_date,
+        error_text,
+    )
 
 
 def utc_now() -> datetime:
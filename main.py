@@ -2,37 +2,79 @@ from __future__ import annotations
 
 import asyncio
 import hashlib
+import hmac
 import logging
 import os
+import random
 import re
+import time
 import uuid
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from html import escape
 
+import orjson
 from fastapi import Depends, FastAPI, Form, Header, HTTPException, Request, status
-from fastapi.responses import HTMLResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from telegram.error import TelegramError
 from telegram import Update
 from telegram.ext import Application, ApplicationBuilder, MessageHandler, filters
 
-from bot_logic import handle_channel_photo_post, handle_discussion_auto_forward
-from config import Settings, get_settings_or_error
+from bot_logic import (
+    COMMENT_WORKERS,
+    PHOTO_WORKERS,
+    PhotoDownloadError,
+    close_httpx_client,
+    comment_worker_loop,
+    dedup_sweeper_loop,
+    download_photo,
+    drain_work_queues,
+    handle_channel_photo_post,
+    handle_discussion_auto_forward,
+    photo_worker_loop,
+    set_db_pool,
+    set_poll_kick,
+)
+from config import Settings, get_settings, get_settings_or_error
 from db import close_pool, create_pool
 from poller import poller_loop, run_poll_once
 from db import get_post
-from timeweb_ai import TimewebAIError, generate_funny_caption
+from timeweb_ai import TimewebAIError, close_ai_client, generate_funny_caption
 
 
 class _RedactTelegramTokenFilter(logging.Filter):
     _re = re.compile(r"(https://api\.telegram\.org/)?bot\d+:[A-Za-z0-9_-]+")
 
+    def __init__(self) -> None:
+        super().__init__()
+        self._token: str | None = None
+
+    def set_token(self, token: str | None) -> None:
+        """
+        Когда токен известен, ищем его как подстроку (str.replace) вместо regex.
+        """
+        self._token = token or None
+
     def filter(self, record: logging.LogRecord) -> bool:  # noqa: A003
+        # Токен может попасть в любой лог (например, URL файла в тексте исключения), поэтому проверяем все записи.
         try:
             msg = record.getMessage()
         except Exception:
             return True
 
-        redacted = self._re.sub("bot<redacted>", msg)
+        token = self._token
+        if token is not None:
+            if token not in msg:
+                return True
+            redacted = msg.replace(f"https://api.telegram.org/bot{token}", "bot<redacted>")
+            redacted = redacted.replace(f"bot{token}", "bot<redacted>").replace(token, "<redacted>")
+        else:
+            # Дешёвая проверка подстроки отсекает почти все строки лога без запуска regex.
+            if "bot" not in msg:
+                return True
+            redacted = self._re.sub("bot<redacted>", msg)
         if redacted != msg:
             record.msg = redacted
             record.args = ()
@@ -44,22 +86,31 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s %(message)s",
 )
 logger = logging.getLogger(__name__)
-# Редактируем логи, чтобы токены Telegram не утекали (URL httpx, тексты исключений и т.д.)
+# Редактируем логи, чтобы токены Telegram не утекали (URL httpx, тексты исключений и т.д.).
+# Фильтр висит на handler'ах, а не на логгерах telegram/httpx: фильтры логгера не применяются
+# к записям дочерних логгеров (telegram.ext.Application и т.п.). Остальные логгеры он пропускает сразу.
+_redact_filter = _RedactTelegramTokenFilter()
 for h in logging.getLogger().handlers:
-    h.addFilter(_RedactTelegramTokenFilter())
+    h.addFilter(_redact_filter)
 # Не логируем HTTP-запросы библиотеки Telegram/httpx с URL, содержащим токен бота.
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("httpx").disabled = True
 logging.getLogger("httpcore").disabled = True
 
+@lru_cache(maxsize=4)
+def _token_fp(token: str) -> str:
+    # 6 байт digest = ровно 12 hex-символов, без среза длинной hex-строки.
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=6).hexdigest()
+
+
 # Диагностика самого раннего старта: какой TELEGRAM_BOT_TOKEN реально попал в env контейнера.
 _raw_boot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+_redact_filter.set_token(_raw_boot_token.strip() if _raw_boot_token else None)
 _instance_id = os.getenv("INSTANCE_ID") or str(uuid.uuid4())
 print(f"BOOT INSTANCE_ID: {_instance_id}", flush=True)
 if _raw_boot_token:
-    _boot_fp = hashlib.sha256(_raw_boot_token.encode("utf-8")).hexdigest()[:12]
-    print(f"BOOT TELEGRAM_BOT_TOKEN fingerprint: {_boot_fp}", flush=True)
+    print(f"BOOT TELEGRAM_BOT_TOKEN fingerprint: {_token_fp(_raw_boot_token)}", flush=True)
 else:
     print("BOOT TELEGRAM_BOT_TOKEN fingerprint: <missing>", flush=True)
 
@@ -75,17 +126,36 @@ def build_telegram_app(settings: Settings) -> Application:
     # Ловим автофорварды в linked discussion group, чтобы связать пост и "discussion message"
     app.add_handler(
         MessageHandler(
-            filters.ChatType.GROUPS,
+            filters.ChatType.GROUPS & filters.IS_AUTOMATIC_FORWARD,
             handle_discussion_auto_forward,
         )
     )
     return app
 
 
-api = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await on_startup()
+    try:
+        yield
+    finally:
+        await on_shutdown()
+
+
+# ORJSONResponse: быстрее сериализует {"ok": true}, который webhook отдаёт на каждый апдейт.
+api = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 telegram_app: Application | None = None
 telegram_task: asyncio.Task | None = None
 poller_task: asyncio.Task | None = None
+dedup_sweeper_task: asyncio.Task | None = None
+photo_worker_tasks: list[asyncio.Task] = []
+comment_worker_tasks: list[asyncio.Task] = []
+# Апдейты, которые обрабатываются фоном после ответа webhook (для аккуратного завершения).
+pending_updates: set[asyncio.Task] = set()
+# Сверх этого числа апдейт обрабатывается до ответа: Telegram притормозит доставку, память не растёт.
+MAX_PENDING_UPDATES = 100
+# Сколько при остановке ждём разбора каждой из очередей воркеров.
+SHUTDOWN_QUEUE_DRAIN_TIMEOUT_S = 20.0
 basic_auth = HTTPBasic()
 
 
@@ -94,21 +164,27 @@ async def init_telegram_in_background(settings: Settings) -> None:
     Инициализация Telegram может включать сетевые вызовы (getMe/setWebhook).
     Чтобы не мешать healthcheck'ам платформы, делаем это фоном.
     """
-    global telegram_app, poller_task
+    global telegram_app, poller_task, dedup_sweeper_task, photo_worker_tasks, comment_worker_tasks
     try:
         app = build_telegram_app(settings)
         await app.initialize()
         await app.start()
         telegram_app = app
         api.state.telegram_app = app
-        # пробрасываем pool в bot_data, чтобы handlers могли писать в БД
-        if getattr(api.state, "db_pool", None) is not None:
-            app.bot_data["db_pool"] = api.state.db_pool
+        # пробрасываем pool в bot_logic, чтобы handlers могли писать в БД
+        set_db_pool(getattr(api.state, "db_pool", None))
+        set_poll_kick(api.state.poll_kick)
 
         # Стартуем poller после готовности telegram_app
         if poller_task is None:
             poller_task = asyncio.create_task(poller_loop(api.state))
             logger.info("Poller started")
+        if dedup_sweeper_task is None:
+            dedup_sweeper_task = asyncio.create_task(dedup_sweeper_loop())
+        if not photo_worker_tasks:
+            photo_worker_tasks = [asyncio.create_task(photo_worker_loop()) for _ in range(PHOTO_WORKERS)]
+        if not comment_worker_tasks:
+            comment_worker_tasks = [asyncio.create_task(comment_worker_loop()) for _ in range(COMMENT_WORKERS)]
 
         try:
             await telegram_app.bot.set_webhook(
@@ -134,21 +210,43 @@ async def root() -> PlainTextResponse:
     return PlainTextResponse(f"OK {_instance_id}")
 
 
+def _settings_or_error() -> tuple[Settings | None, str | None]:
+    # Конфиг читается один раз на старте; до старта — как раньше, напрямую.
+    if hasattr(api.state, "settings_error"):
+        return api.state.settings, api.state.settings_error
+    return get_settings_or_error()
+
+
+# Тело ответа /health меняется только вместе с состоянием webhook: храним готовые байты.
+_health_cache: tuple[tuple[bool, str | None], bytes] | None = None
+
+
 @api.get("/health")
-async def health() -> dict[str, object]:
-    settings, err = get_settings_or_error()
-    token_fp = None
-    if settings is not None and err is None:
-        token_fp = hashlib.sha256(settings.telegram_bot_token.encode("utf-8")).hexdigest()[:12]
-    return {
-        "status": "ok",
-        "instance_id": _instance_id,
-        "config_ok": err is None,
-        "config_error": err,
-        "bot_token_fp": token_fp,
-        "webhook_configured": bool(getattr(api.state, "webhook_configured", False)),
-        "webhook_error": getattr(api.state, "webhook_error", None),
-    }
+async def health() -> Response:
+    global _health_cache
+    state_key = (
+        bool(getattr(api.state, "webhook_configured", False)),
+        getattr(api.state, "webhook_error", None),
+    )
+    if _health_cache is None or _health_cache[0] != state_key:
+        # Конфиг закэширован на старте, fingerprint — в lru_cache.
+        settings, err = _settings_or_error()
+        token_fp = _token_fp(settings.telegram_bot_token) if settings is not None and err is None else None
+        body = orjson.dumps(
+            {
+                "status": "ok",
+                "instance_id": _instance_id,
+                "config_ok": err is None,
+                "config_error": err,
+                "bot_token_fp": token_fp,
+                "webhook_configured": state_key[0],
+                "webhook_error": state_key[1],
+            }
+        )
+        if hasattr(api.state, "settings_error"):
+            _health_cache = (state_key, body)
+        return Response(content=body, media_type="application/json")
+    return Response(content=_health_cache[1], media_type="application/json")
 
 
 def _check_basic_auth(credentials: HTTPBasicCredentials, settings: Settings) -> None:
@@ -165,13 +263,60 @@ def _check_basic_auth(credentials: HTTPBasicCredentials, settings: Settings) ->
         )
 
 
+_ADMIN_PAGE_HEAD = """
+    <html>
+      <head>
+        <meta charset="utf-8"/>
+        <title>EB Bot Admin</title>
+        <style>
+          body { font-family: Arial, sans-serif; margin: 20px; }
+          table { border-collapse: collapse; width: 100%; margin-bottom: 24px; }
+          th, td { border: 1px solid #ddd; padding: 6px 8px; font-size: 12px; }
+          th { background: #f4f4f4; text-align: left; }
+          .actions { margin: 8px 0 24px; }
+        </style>
+      </head>
+      <body>
+        <div class="actions">
+          <form method="post" action="/admin/poll/run">
+            <label>Channel ID: <input name="channel_id" placeholder="-100123..." /></label>
+            <button type="submit">Запустить опрос вручную</button>
+          </form>
+          <form method="post" action="/admin/post/regenerate">
+            <label>Channel ID: <input name="channel_id" placeholder="-100123..." /></label>
+            <label>Message ID: <input name="message_id" placeholder="12345" /></label>
+            <small>Нужен message_id поста в канале, не комментария.</small>
+            <button type="submit">Пересоздать подпись к посту</button>
+          </form>
+        </div>
+"""
+
+# Колонки таблиц админки в порядке SELECT (строки выводятся по r.values()).
+_ADMIN_POSTS_COLUMNS = (
+    "channel_id", "message_id", "post_date", "photo_file_id",
+    "discussion_chat_id", "discussion_message_id", "created_at",
+)
+_ADMIN_POLLS_COLUMNS = (
+    "channel_id", "poll_date", "scheduled_at", "posted_at", "skipped_at",
+    "poll_message_id", "chosen_post_message_id", "question", "last_error", "last_error_at",
+)
+
+
+def _table_chunks(headers: tuple[str, ...], rows: list) -> Iterator[str]:
+    # Таблица отдаётся по строкам: вся страница целиком в памяти не собирается.
+    yield "<table><thead><tr>" + "".join(f"<th>{escape(h)}</th>" for h in headers) + "</tr></thead><tbody>"
+    for r in rows:
+        yield "<tr><td>" + "</td><td>".join(escape("" if v is None else str(v)) for v in r.values()) + "</td></tr>"
+    yield "</tbody></table>"
+
+
 @api.get("/admin", response_class=HTMLResponse)
 async def admin_page(
     credentials: HTTPBasicCredentials = Depends(basic_auth),
     limit: int = 50,
     offset: int = 0,
-) -> HTMLResponse:
-    settings, err = get_settings_or_error()
+) -> StreamingResponse:
+    settings, err = _settings_or_error()
     if err is not None or settings is None:
         raise HTTPException(status_code=503, detail="service not configured")
 
@@ -184,101 +329,43 @@ async def admin_page(
     limit = max(1, min(200, int(limit)))
     offset = max(0, int(offset))
 
-    async with pool.acquire() as conn:
-        posts = await conn.fetch(
+    # Выборки независимы: выполняем параллельно на двух соединениях из пула.
+    async def _fetch(sql: str) -> list:
+        async with pool.acquire() as conn:
+            return await conn.fetch(sql, limit, offset)
+
+    posts, polls = await asyncio.gather(
+        _fetch(
             """
             SELECT channel_id, message_id, post_date, photo_file_id,
                    discussion_chat_id, discussion_message_id, created_at
             FROM posts
             ORDER BY created_at DESC
             LIMIT $1 OFFSET $2
-            """,
-            limit,
-            offset,
-        )
-        polls = await conn.fetch(
+            """
+        ),
+        _fetch(
             """
             SELECT channel_id, poll_date, scheduled_at, posted_at, skipped_at,
                    poll_message_id, chosen_post_message_id, question, last_error, last_error_at
             FROM daily_poll
             ORDER BY poll_date DESC, channel_id
             LIMIT $1 OFFSET $2
-            """,
-            limit,
-            offset,
-        )
+            """
+        ),
+    )
 
-    def _table(headers: list[str], rows: list[list[str]]) -> str:
-        th = "".join(f"<th>{escape(h)}</th>" for h in headers)
-        trs = []
-        for r in rows:
-            tds = "".join(f"<td>{escape(x)}</td>" for x in r)
-            trs.append(f"<tr>{tds}</tr>")
-        return f"<table><thead><tr>{th}</tr></thead><tbody>{''.join(trs)}</tbody></table>"
-
-    posts_rows = [
-        [
-            str(r["channel_id"]),
-            str(r["message_id"]),
-            str(r["post_date"]),
-            str(r["photo_file_id"] or ""),
-            str(r["discussion_chat_id"] or ""),
-            str(r["discussion_message_id"] or ""),
-            str(r["created_at"]),
-        ]
-        for r in posts
-    ]
-    polls_rows = [
-        [
-            str(r["channel_id"]),
-            str(r["poll_date"]),
-            str(r["scheduled_at"]),
-            str(r["posted_at"] or ""),
-            str(r["skipped_at"] or ""),
-            str(r["poll_message_id"] or ""),
-            str(r["chosen_post_message_id"] or ""),
-            str(r["question"] or ""),
-            str(r["last_error"] or ""),
-            str(r["last_error_at"] or ""),
-        ]
-        for r in polls
-    ]
-
-    html = f"""
-    <html>
-      <head>
-        <meta charset="utf-8"/>
-        <title>EB Bot Admin</title>
-        <style>
-          body {{ font-family: Arial, sans-serif; margin: 20px; }}
-          table {{ border-collapse: collapse; width: 100%; margin-bottom: 24px; }}
-          th, td {{ border: 1px solid #ddd; padding: 6px 8px; font-size: 12px; }}
-          th {{ background: #f4f4f4; text-align: left; }}
-          .actions {{ margin: 8px 0 24px; }}
-        </style>
-      </head>
-      <body>
-        <div class="actions">
-          <form method="post" action="/admin/poll/run">
-            <label>Channel ID: <input name="channel_id" placeholder="-100123..." /></label>
-            <button type="submit">Запустить опрос вручную</button>
-          </form>
-          <form method="post" action="/admin/post/regenerate">
-            <label>Channel ID: <input name="channel_id" placeholder="-100123..." /></label>
-            <label>Message ID: <input name="message_id" placeholder="12345" /></label>
-            <small>Нужен message_id поста в канале, не комментария.</small>
-            <button type="submit">Пересоздать подпись к посту</button>
-          </form>
-        </div>
-        <h2>posts</h2>
-        {_table(["channel_id","message_id","post_date","photo_file_id","discussion_chat_id","discussion_message_id","created_at"], posts_rows)}
-        <h2>daily_poll</h2>
-        {_table(["channel_id","poll_date","scheduled_at","posted_at","skipped_at","poll_message_id","chosen_post_message_id","question","last_error","last_error_at"], polls_rows)}
-        <p>limit={limit} offset={offset}</p>
-      </body>
-    </html>
-    """
-    return HTMLResponse(html)
+    async def _render() -> AsyncIterator[str]:
+        yield _ADMIN_PAGE_HEAD
+        yield "<h2>posts</h2>"
+        for chunk in _table_chunks(_ADMIN_POSTS_COLUMNS, posts):
+            yield chunk
+        yield "<h2>daily_poll</h2>"
+        for chunk in _table_chunks(_ADMIN_POLLS_COLUMNS, polls):
+            yield chunk
+        yield f"<p>limit={limit} offset={offset}</p></body></html>"
+
+    return StreamingResponse(_render(), media_type="text/html; charset=utf-8")
 
 
 @api.post("/admin/poll/run")
@@ -286,7 +373,7 @@ async def admin_run_poll(
     credentials: HTTPBasicCredentials = Depends(basic_auth),
     channel_id: str | None = Form(default=None),
 ) -> dict[str, object]:
-    settings, err = get_settings_or_error()
+    settings, err = _settings_or_error()
     if err is not None or settings is None:
         raise HTTPException(status_code=503, detail="service not configured")
     _check_basic_auth(credentials, settings)
@@ -308,7 +395,7 @@ async def admin_regenerate_post_caption(
     channel_id: str | None = Form(default=None),
     message_id: str | None = Form(default=None),
 ) -> dict[str, object]:
-    settings, err = get_settings_or_error()
+    settings, err = _settings_or_error()
     if err is not None or settings is None:
         raise HTTPException(status_code=503, detail="service not configured")
     _check_basic_auth(credentials, settings)
@@ -326,7 +413,8 @@ async def admin_regenerate_post_caption(
     if pool is None:
         raise HTTPException(status_code=503, detail="db not configured")
 
-    post = await get_post(pool, channel_id_int, message_id_int)
+    async with pool.acquire() as conn:
+        post = await get_post(conn, channel_id_int, message_id_int)
     if not post:
         return {"ok": False, "reason": "post_not_found"}
 
@@ -335,11 +423,28 @@ async def admin_regenerate_post_caption(
     discussion_message_id = post.get("discussion_message_id")
     if not photo_file_id:
         return {"ok": False, "reason": "no_photo_file_id"}
+
+    app = getattr(api.state, "telegram_app", None)
+    if app is None:
+        return {"ok": False, "reason": "telegram_app_not_ready"}
+
+    # Картинка не зависит от mapping: качаем её, пока ждём автофорвард.
+    download_task = asyncio.ensure_future(download_photo(app.bot, photo_file_id))
+
     if not discussion_chat_id or not discussion_message_id:
-        # Подождём появления mapping (автофорвард мог прийти чуть позже)
-        for _ in range(10):
-            await asyncio.sleep(0.8)
-            post = await get_post(pool, channel_id_int, message_id_int)
+        # Подождём появления mapping (автофорвард мог прийти чуть позже).
+        # Экспоненциальная пауза с джиттером, чтобы параллельные запросы не просыпались синхронно.
+        deadline = time.monotonic() + 8.0
+        attempt = 0
+        while True:
+            delay = min(0.25 * 2**attempt, 2.0) * (0.5 + random.random())
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(delay, remaining))
+            attempt += 1
+            async with pool.acquire() as conn:
+                post = await get_post(conn, channel_id_int, message_id_int)
             if not post:
                 break
             discussion_chat_id = post.get("discussion_chat_id")
@@ -347,16 +452,21 @@ async def admin_regenerate_post_caption(
             if discussion_chat_id and discussion_message_id:
                 break
         if not discussion_chat_id or not discussion_message_id:
+            download_task.cancel()
+            # Ошибка скачивания здесь уже не важна: забираем её, чтобы asyncio не ругался в лог.
+            download_task.add_done_callback(lambda t: t.cancelled() or t.exception())
             return {"ok": False, "reason": "no_discussion_mapping"}
 
-    app = getattr(api.state, "telegram_app", None)
-    if app is None:
-        return {"ok": False, "reason": "telegram_app_not_ready"}
+    # getFile (TelegramError) и само скачивание — ошибки загрузки, а не отправки комментария.
+    try:
+        image_bytes = await download_task
+    except (TelegramError, PhotoDownloadError) as e:
+        # Только текст ошибки, без traceback: PhotoDownloadError уже очищен от URL с токеном.
+        logger.error("Admin regenerate failed to download photo: %s", e)
+        return {"ok": False, "reason": "download_failed"}
 
     try:
-        tg_file = await app.bot.get_file(photo_file_id)
-        image_bytes = bytes(await tg_file.download_as_bytearray())
-        caption = await generate_funny_caption(image_bytes=image_bytes, original_caption=None)
+        caption = await generate_funny_caption(image_bytes=image_bytes, original_caption=None, use_cache=False)
         await app.bot.send_message(
             chat_id=int(discussion_chat_id),
             text=caption,
@@ -372,13 +482,17 @@ async def admin_regenerate_post_caption(
     return {"ok": True}
 
 
-@api.on_event("startup")
 async def on_startup() -> None:
     global telegram_task, poller_task
 
     settings, err = get_settings_or_error()
     api.state.webhook_configured = False
     api.state.webhook_error = None
+    # Env не меняется во время работы: эндпоинты берут конфиг отсюда, а не парсят его на каждый запрос.
+    api.state.settings = settings
+    api.state.settings_error = err
+    api.state.webhook_secrets = None
+    api.state.poll_kick = asyncio.Event()
 
     if err is not None:
         # Важно: не валим приложение, чтобы healthcheck контейнера прошёл,
@@ -389,7 +503,12 @@ async def on_startup() -> None:
     # DB pool (для режима опросов/статистики)
     if settings.database_dsn:
         try:
-            pool = await create_pool(settings.database_dsn)
+            pool = await create_pool(
+                settings.database_dsn,
+                min_size=settings.database_pool_min,
+                max_size=settings.database_pool_max,
+                statement_cache_size=settings.database_statement_cache_size,
+            )
             api.state.db_pool = pool
         except Exception:
             logger.exception("DB init failed; daily poll disabled")
@@ -398,26 +517,65 @@ async def on_startup() -> None:
         api.state.db_pool = None
 
     # Логируем fingerprint токена, чтобы было видно, какой токен реально подхватился из env.
-    token_fp = hashlib.sha256(settings.telegram_bot_token.encode("utf-8")).hexdigest()[:12]
+    api.state.webhook_secrets = (
+        settings.webhook_path_secret.encode("utf-8"),
+        settings.telegram_webhook_secret_token.encode("utf-8"),
+    )
+
+    # Нормализованный токен из настроек (без кавычек/пробелов) — для редактирования логов.
+    _redact_filter.set_token(settings.telegram_bot_token)
+
+    token_fp = _token_fp(settings.telegram_bot_token)
     logger.info("Bot token fingerprint: %s", token_fp)
 
     # Фоновая инициализация Telegram, чтобы не блокировать readiness.
     telegram_task = asyncio.create_task(init_telegram_in_background(settings))
 
 
-@api.on_event("shutdown")
 async def on_shutdown() -> None:
     global telegram_app
     global telegram_task
     global poller_task
+    global dedup_sweeper_task
+    global photo_worker_tasks
+    global comment_worker_tasks
 
+    background_tasks: list[asyncio.Task] = []
     if telegram_task is not None:
         telegram_task.cancel()
+        background_tasks.append(telegram_task)
         telegram_task = None
 
+    # Даём уже принятым апдейтам дообработаться.
+    if pending_updates:
+        await asyncio.gather(*pending_updates, return_exceptions=True)
+
+    # Затем — уже поставленным в очереди постам и комментариям (клиенты и пул ещё открыты).
+    if photo_worker_tasks or comment_worker_tasks:
+        await drain_work_queues(SHUTDOWN_QUEUE_DRAIN_TIMEOUT_S)
+
     if poller_task is not None:
-        poller_task.cancel()
+        background_tasks.append(poller_task)
         poller_task = None
+    if dedup_sweeper_task is not None:
+        background_tasks.append(dedup_sweeper_task)
+        dedup_sweeper_task = None
+    background_tasks += photo_worker_tasks
+    background_tasks += comment_worker_tasks
+    photo_worker_tasks = []
+    comment_worker_tasks = []
+    for task in background_tasks:
+        task.cancel()
+    # Дожидаемся отмены, чтобы ни одна задача не обращалась к закрытым клиентам и пулу.
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    set_db_pool(None)
+    set_poll_kick(None)
+    # Следующий старт (в том же процессе) перечитает env.
+    get_settings.cache_clear()
+
+    await close_httpx_client()
+    await close_ai_client()
 
     if telegram_app is None:
         # Закрываем DB pool, если есть
@@ -439,24 +597,61 @@ async def on_shutdown() -> None:
         await close_pool(pool)
 
 
-@api.post("/webhook/{path_secret}")
+def _is_relevant_update(data: object) -> bool:
+    """
+    Дешёвый префильтр по сырому JSON, повторяющий условия handlers:
+    фото-посты канала и автофорварды в чат обсуждений.
+    """
+    if not isinstance(data, dict):
+        return False
+    post = data.get("channel_post") or data.get("edited_channel_post")
+    if post is not None:
+        return "photo" in post
+    message = data.get("message") or data.get("edited_message")
+    return message is not None and bool(message.get("is_automatic_forward"))
+
+
+# Ответ webhook всегда один и тот же: отдаём готовые байты, без response_model и сериализации.
+_WEBHOOK_OK_BODY = orjson.dumps({"ok": True})
+
+
+def _webhook_ok() -> Response:
+    return Response(content=_WEBHOOK_OK_BODY, media_type="application/json")
+
+
+@api.post("/webhook/{path_secret}", response_class=Response)
 async def telegram_webhook(
     path_secret: str,
     request: Request,
     x_telegram_bot_api_secret_token: str | None = Header(default=None),
-) -> dict[str, bool]:
-    settings, err = get_settings_or_error()
+) -> Response:
+    settings, err = _settings_or_error()
     if err is not None or settings is None or telegram_app is None:
         raise HTTPException(status_code=503, detail="service not configured")
 
-    if path_secret != settings.webhook_path_secret:
+    path_secret_b, secret_token_b = api.state.webhook_secrets
+    if not hmac.compare_digest(path_secret.encode("utf-8"), path_secret_b):
         raise HTTPException(status_code=404, detail="not found")
 
-    if x_telegram_bot_api_secret_token != settings.telegram_webhook_secret_token:
+    if not hmac.compare_digest((x_telegram_bot_api_secret_token or "").encode("utf-8"), secret_token_b):
         raise HTTPException(status_code=403, detail="forbidden")
 
-    data = await request.json()
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="invalid json")
+
+    # Апдейты, которые не дойдут ни до одного handler'а, не разбираем в объекты PTB.
+    if not _is_relevant_update(data):
+        return _webhook_ok()
+
     update = Update.de_json(data=data, bot=telegram_app.bot)
-    await telegram_app.process_update(update)
-    return {"ok": True}
+    if len(pending_updates) >= MAX_PENDING_UPDATES:
+        await telegram_app.process_update(update)
+        return _webhook_ok()
+    # Отвечаем Telegram сразу, обработка апдейта идёт фоном.
+    task = asyncio.create_task(telegram_app.process_update(update))
+    pending_updates.add(task)
+    task.add_done_callback(pending_updates.discard)
+    return _webhook_ok()
 
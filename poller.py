@@ -2,39 +2,89 @@ from __future__ import annotations
 
 import asyncio
 import logging
+from collections import OrderedDict
 from datetime import datetime, time as dtime
 from zoneinfo import ZoneInfo
 
 from telegram.error import TelegramError
 
+from bot_logic import PhotoDownloadError, download_photo
 from config import get_settings
 from db import (
-    count_posts_for_date,
+    count_and_pick_random_post,
     ensure_daily_poll,
-    force_schedule_daily_poll,
+    force_schedule_daily_polls,
     get_due_polls,
+    mark_poll_failed,
     mark_poll_posted,
-    mark_poll_error,
     mark_poll_skipped,
-    pick_random_post,
+    next_due_at,
     utc_now,
 )
 from timeweb_ai import TimewebAIError, generate_poll_options, generate_poll_question
 
 logger = logging.getLogger(__name__)
 
+# Картинки выбранных для опроса постов: повторная попытка (после ошибки отправки или ручной запуск)
+# не качает тот же файл из Telegram заново. key: photo_file_id, LRU.
+_POLL_IMAGES: OrderedDict[str, bytearray] = OrderedDict()
+_POLL_IMAGES_MAX = 16
+
+
+# Границы сна планировщика между проверками.
+_POLL_MIN_SLEEP_S = 1.0
+_POLL_MAX_SLEEP_S = 3600.0
+# Повтор для просроченных, но не опубликованных опросов (мало постов, ошибка отправки).
+_POLL_RETRY_S = 60.0
+
 
 async def poller_loop(state) -> None:
     """
     Фоновый планировщик ежедневных опросов.
+    Спит до ближайшего scheduled_at; новые посты будят его раньше через state.poll_kick.
     """
     logger.info("Poller loop initialized")
+    kick: asyncio.Event = state.poll_kick
     while True:
+        kick.clear()
+        sleep_s = _POLL_RETRY_S
         try:
-            await run_poll_once(state)
+            result = await run_poll_once(state)
+            sleep_s = await _seconds_until_next_poll(state, posted=bool(result.get("ok")))
         except Exception:
             logger.exception("Poller loop error")
-        await asyncio.sleep(60)
+        try:
+            await asyncio.wait_for(kick.wait(), timeout=sleep_s)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _seconds_until_next_poll(state, posted: bool) -> float:
+    pool = getattr(state, "db_pool", None)
+    poll_channels = get_settings().daily_poll_channel_ids
+    if pool is None or not poll_channels:
+        return _POLL_MAX_SLEEP_S
+    async with pool.acquire() as conn:
+        due_at = await next_due_at(conn, list(poll_channels))
+    if due_at is None:
+        return _POLL_MAX_SLEEP_S
+    sleep_s = (due_at - utc_now()).total_seconds()
+    if sleep_s <= 0 and not posted:
+        # Опрос уже просрочен, но сейчас не опубликовался — не крутимся вхолостую.
+        return _POLL_RETRY_S
+    return max(_POLL_MIN_SLEEP_S, min(_POLL_MAX_SLEEP_S, sleep_s))
+
+
+async def _download_poll_image(bot, photo_file_id: str) -> bytearray:
+    image_buf = _POLL_IMAGES.get(photo_file_id)
+    if image_buf is not None:
+        _POLL_IMAGES.move_to_end(photo_file_id)
+        return image_buf
+    image_buf = await download_photo(bot, photo_file_id)
+    _POLL_IMAGES[photo_file_id] = image_buf
+    if len(_POLL_IMAGES) > _POLL_IMAGES_MAX:
+        _POLL_IMAGES.popitem(last=False)
+    return image_buf
 
 
 async def run_poll_once(
@@ -58,17 +108,23 @@ async def run_poll_once(
     if app is None:
         return {"ok": False, "reason": "telegram_app_not_ready"}
 
+    # Лишние каналы отсекает сам запрос к БД.
+    if force_channel_id is None:
+        due_channels = list(poll_channels)
+    else:
+        due_channels = [force_channel_id] if force_channel_id in poll_channels else []
+
     now_utc = utc_now()
-    due = await get_due_polls(pool, now_utc)
-    if not due and force:
-        # Принудительный запуск: создаём poll на "сейчас" для всех разрешённых каналов.
-        tz = ZoneInfo(settings.daily_poll_timezone)
-        now_local = datetime.now(tz)
-        poll_date = now_local.date()
-        channels = [force_channel_id] if force_channel_id is not None else list(poll_channels)
-        for channel_id in channels:
-            await force_schedule_daily_poll(pool, channel_id, poll_date, now_utc)
-        due = await get_due_polls(pool, now_utc)
+    async with pool.acquire() as conn:
+        due = await get_due_polls(conn, now_utc, due_channels)
+        if not due and force:
+            # Принудительный запуск: создаём poll на "сейчас" для всех разрешённых каналов.
+            tz = ZoneInfo(settings.daily_poll_timezone)
+            now_local = datetime.now(tz)
+            poll_date = now_local.date()
+            channels = [force_channel_id] if force_channel_id is not None else list(poll_channels)
+            await force_schedule_daily_polls(conn, channels, poll_date, now_utc)
+            due = await get_due_polls(conn, now_utc, due_channels)
     if not due:
         return {"ok": False, "reason": "no_due_polls"}
 
@@ -80,18 +136,14 @@ async def run_poll_once(
         channel_id = int(row["channel_id"])
         poll_date = row["poll_date"]
 
-        if channel_id not in poll_channels:
-            continue
-        if force_channel_id is not None and channel_id != force_channel_id:
-            continue
-
         # окно публикации
         start_dt = datetime.combine(poll_date, start_t, tzinfo=tz)
         end_dt = datetime.combine(poll_date, end_t, tzinfo=tz)
         now_local = datetime.now(tz)
         if now_local > end_dt and not force:
             # Если окно уже прошло — помечаем как пропущенный опрос.
-            await mark_poll_skipped(pool, channel_id, poll_date)
+            async with pool.acquire() as conn:
+                await mark_poll_skipped(conn, channel_id, poll_date)
             logger.info(
                 "Daily poll skipped: window passed (channel_id=%s, date=%s)",
                 channel_id,
@@ -99,8 +151,10 @@ async def run_poll_once(
             )
             continue
 
-        # Нужно минимум N постов за день
-        posts_count = await count_posts_for_date(pool, channel_id, poll_date)
+        # Нужно минимум N постов за день; подсчёт и выбор поста — одним запросом.
+        async with pool.acquire() as conn:
+            posts_count, post = await count_and_pick_random_post(conn, channel_id, poll_date)
+
         if posts_count < settings.daily_poll_min_posts and not force:
             logger.info(
                 "Daily poll not posted: not enough posts (%s/%s) for channel_id=%s date=%s",
@@ -111,7 +165,6 @@ async def run_poll_once(
             )
             continue
 
-        post = await pick_random_post(pool, channel_id, poll_date)
         if not post:
             logger.info(
                 "Daily poll not posted: no posts found for channel_id=%s date=%s",
@@ -131,20 +184,21 @@ async def run_poll_once(
             )
             continue
 
-        # Загружаем картинку
+        # Загружаем картинку: буфер скачивания передаём в AI как есть, без копии в bytes.
         try:
-            tg_file = await app.bot.get_file(photo_file_id)
-            image_bytes = bytes(await tg_file.download_as_bytearray())
-        except TelegramError:
-            logger.exception("Не удалось скачать картинку для опроса")
+            image_buf = await _download_poll_image(app.bot, photo_file_id)
+        except (TelegramError, PhotoDownloadError) as e:
+            # Только текст ошибки, без traceback: PhotoDownloadError уже очищен от URL с токеном.
+            logger.error("Не удалось скачать картинку для опроса: %s", e)
             return {"ok": False, "reason": "download_photo_failed", "channel_id": channel_id, "date": str(poll_date)}
+        image_bytes = memoryview(image_buf)
 
         try:
             question = await generate_poll_question(image_bytes=image_bytes)
         except TimewebAIError as e:
             logger.exception("Не удалось сгенерировать вопрос опроса через AI")
-            await mark_poll_error(pool, channel_id, poll_date, str(e))
-            await mark_poll_skipped(pool, channel_id, poll_date)
+            async with pool.acquire() as conn:
+                await mark_poll_failed(conn, channel_id, poll_date, str(e))
             return {"ok": False, "reason": "ai_question_failed", "channel_id": channel_id, "date": str(poll_date)}
 
         try:
@@ -155,8 +209,8 @@ async def run_poll_once(
             )
         except TimewebAIError as e:
             logger.exception("Не удалось сгенерировать варианты опроса через AI (2 попытки)")
-            await mark_poll_error(pool, channel_id, poll_date, str(e))
-            await mark_poll_skipped(pool, channel_id, poll_date)
+            async with pool.acquire() as conn:
+                await mark_poll_failed(conn, channel_id, poll_date, str(e))
             return {"ok": False, "reason": "ai_options_failed", "channel_id": channel_id, "date": str(poll_date)}
 
         try:
@@ -175,15 +229,18 @@ async def run_poll_once(
             logger.exception("Не удалось отправить опрос в канал")
             return {"ok": False, "reason": "send_poll_failed", "channel_id": channel_id, "date": str(poll_date)}
 
-        await mark_poll_posted(
-            pool=pool,
-            channel_id=channel_id,
-            poll_date=poll_date,
-            poll_message_id=poll_msg.message_id,
-            chosen_post_message_id=int(post["message_id"]),
-            question=question,
-            options=options,
-        )
+        async with pool.acquire() as conn:
+            await mark_poll_posted(
+                conn=conn,
+                channel_id=channel_id,
+                poll_date=poll_date,
+                poll_message_id=poll_msg.message_id,
+                chosen_post_message_id=int(post["message_id"]),
+                question=question,
+                options=options,
+            )
+        # Опрос опубликован — картинка больше не понадобится.
+        _POLL_IMAGES.pop(photo_file_id, None)
         return {"ok": True, "channel_id": channel_id, "date": str(poll_date), "poll_message_id": poll_msg.message_id}
 
     return {"ok": False, "reason": "no_poll_posted"}
@@ -1,14 +1,35 @@
 from __future__ import annotations
 
-import base64
-import json
+import asyncio
+import gzip
+import hashlib
+import heapq
 import logging
 import random
-from typing import Any
+import re
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from functools import lru_cache, partial
+from typing import Any, TypeVar
 
 import httpx
+import orjson
 
-from config import get_settings
+try:
+    # SIMD-реализация base64 (AVX2/NEON): в разы быстрее stdlib на фото в сотни КБ
+    # и умеет кодировать сразу в str, без промежуточного bytes.
+    import pybase64
+
+    _b64encode_str = pybase64.b64encode_as_string
+except ImportError:
+    import binascii
+
+    def _b64encode_str(data: bytes | bytearray | memoryview) -> str:
+        # base64.b64encode — обёртка над тем же binascii; зовём его напрямую, без перевода строки.
+        return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+from config import Settings, get_settings
 
 
 class TimewebAIError(RuntimeError):
@@ -17,14 +38,184 @@ class TimewebAIError(RuntimeError):
 
 logger = logging.getLogger(__name__)
 
+_T = TypeVar("_T")
+
+# Общий keep-alive клиент к AI API: TLS-соединения переиспользуются между вызовами.
+_CLIENT: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            http2=True,
+            timeout=get_settings().timeweb_ai_timeout_s,
+            # Между подписями к постам альбома/пачки проходят секунды — держим соединение дольше дефолтных 5 с.
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=30.0),
+        )
+    return _CLIENT
+
+
+async def close_ai_client() -> None:
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+    # Следующий старт (в том же процессе) перечитает env — вместе с ним и endpoint.
+    _endpoint.cache_clear()
+    _CAPTION_CACHE.clear()
+
+
+@lru_cache(maxsize=1)
+def _endpoint() -> tuple[str, dict[str, str]]:
+    """
+    URL chat-completions и заголовки: зависят только от настроек, собираем один раз.
+    """
+    settings = get_settings()
+    base = settings.timeweb_ai_base_url.rstrip("/")
+    path = settings.timeweb_ai_chat_path.strip()
+    if not path.startswith("/"):
+        path = "/" + path
+    headers = {
+        "Authorization": f"Bearer {settings.timeweb_ai_api_key}",
+        "Content-Type": "application/json",
+    }
+    return base + path, headers
+
+
+# Промпты не зависят от запроса — собираем строки один раз при импорте.
+_CAPTION_SYSTEM_PROMPT = (
+    "Ты — инженерный бот космической исследовательской станции в стиле научной фантастики. "
+    "Дружелюбный и смешной, иногда меланхоличный, иногда мечтательный. "
+    "Твоя задача — смешно, но без токсичности, оскорблений и политики. "
+)
+_CAPTION_STRICT_SYSTEM_PROMPT = (
+    "Ты пишешь подписи к картинкам. Ответ НЕ может быть пустым. "
+    "Верни одну короткую подпись, только текст."
+)
+_CAPTION_USER_PROMPT = (
+    "Придумай одну короткую смешную подпись (до 280 символов) к картинке. "
+    "Верни только подпись, без кавычек, без хэштегов, без объяснений."
+)
+_EMOJI_USER_PROMPT = (
+    "Сделай emoji-реакцию на картинку: 3–5 эмодзи + короткая подпись. "
+    "Верни одну строку, без кавычек и хэштегов."
+)
+_CAPTION_CONTEXT_PREFIX = "\nКонтекст/подпись автора поста: "
+_NO_IMAGE_SUFFIX = "\nЕсли ты не видишь изображение, всё равно верни смешную подпись."
+
+_POLL_QUESTION_SYSTEM_PROMPT = "Ты придумываешь короткие вопросы для опросов по картинке."
+_POLL_QUESTION_STRICT_SYSTEM_PROMPT = (
+    "Ты генерируешь вопрос для опроса по картинке. "
+    "Ответ НЕ может быть пустым. Только один вопрос."
+)
+_POLL_QUESTION_USER_PROMPT = (
+    "Придумай короткий универсальный и смешной вопрос для опроса по предоставленной картинке. "
+    "Один вопрос, 3–8 слов, без кавычек и нумерации. "
+    "Верни только вопрос одной строкой."
+)
+
+_POLL_OPTIONS_SYSTEM_PROMPT = (
+    "Ты придумываешь варианты ответов для опросов по картинке. "
+    "Текст короткий, нейтральный, без токсичности."
+)
+_POLL_OPTIONS_STRICT_SYSTEM_PROMPT = (
+    "Ты генерируешь смешные варианты ответов для опроса. "
+    "Ответ НЕ может быть пустым. Только варианты, каждый в новой строке."
+)
+_POLL_OPTIONS_USER_PROMPT = (
+    "Сгенерируй {options_count} коротких СМЕШНЫХ вариантов ответа для опроса.\n"
+    "Вопрос: «{question}»\n"
+    "Каждый вариант 2–6 слов, без нумерации, без кавычек, без хэштегов.\n"
+    "Верни только список вариантов, каждый в новой строке."
+)
+
+
+# Картинка может прийти как bytes, bytearray (буфер скачивания) или memoryview — без копий.
+ImageBytes = bytes | bytearray | memoryview
+
+
+_MIME_PNG = "image/png"
+_MIME_JPEG = "image/jpeg"
+_MIME_GIF = "image/gif"
+_MIME_WEBP = "image/webp"
+_MIME_HEIC = "image/heic"
+_MIME_UNKNOWN = "application/octet-stream"
+
+# Сигнатуры форматов: (длина префикса, {префикс: mime}). JPEG первым — почти все фото из Telegram.
+_MAGIC_PREFIXES: tuple[tuple[int, dict[bytes, str]], ...] = (
+    (3, {b"\xff\xd8\xff": _MIME_JPEG}),
+    (6, {b"GIF87a": _MIME_GIF, b"GIF89a": _MIME_GIF}),
+    (8, {b"\x89PNG\r\n\x1a\n": _MIME_PNG}),
+)
+# Контейнерные форматы: сигнатура не в начале файла, а в байтах 8..12.
+_HEIC_BRANDS = frozenset((b"heic", b"heix"))
+
+# Готовые префиксы data: URL — на запрос остаётся только склейка с base64-строкой.
+_DATA_URL_PREFIXES = {
+    mime: f"data:{mime};base64,"
+    for mime in (_MIME_PNG, _MIME_JPEG, _MIME_GIF, _MIME_WEBP, _MIME_HEIC, _MIME_UNKNOWN)
+}
+
+
+def _guess_mime(image_bytes: ImageBytes) -> str:
+    # Очень простой guess по сигнатуре — достаточно для фото, стикеров и анимаций из Telegram.
+    # Срез memoryview не копирует буфер; в bytes переносим только 12 байт заголовка.
+    head = bytes(memoryview(image_bytes)[:12])
+    for size, table in _MAGIC_PREFIXES:
+        mime = table.get(head[:size])
+        if mime is not None:
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return _MIME_WEBP
+    if head[4:8] == b"ftyp" and head[8:12] in _HEIC_BRANDS:
+        return _MIME_HEIC
+    return _MIME_UNKNOWN
+
+
+def _check_image_size(image_bytes: ImageBytes, max_bytes: int) -> None:
+    # Страховка от патологически больших картинок: base64 раздувает их ещё на треть.
+    size = memoryview(image_bytes).nbytes
+    if max_bytes > 0 and size > max_bytes:
+        raise TimewebAIError(f"Картинка слишком большая для AI: {size} байт (лимит {max_bytes})")
+
+
+# С какого размера картинки хэш/base64 уносим в поток. Фото из Telegram (сотни КБ) кодируются
+# за доли миллисекунды — дешевле переключения на поток; мегабайты уже заметно держат event loop.
+_OFFLOAD_MIN_BYTES = 1024 * 1024
+
+
+async def _image_cpu(fn: Callable[[ImageBytes], _T], image_bytes: ImageBytes) -> _T:
+    if memoryview(image_bytes).nbytes >= _OFFLOAD_MIN_BYTES:
+        return await asyncio.to_thread(fn, image_bytes)
+    return fn(image_bytes)
+
+
+def _image_data_url(image_bytes: ImageBytes) -> str:
+    """
+    data: URL картинки для image_url. base64 кодируется одним выражением:
+    промежуточные строки не держатся в локальных переменных до конца запроса.
+    С pybase64 base64 сразу получается str — копий две (str и итоговая строка), без него три.
+    """
+    return _DATA_URL_PREFIXES[_guess_mime(image_bytes)] + _b64encode_str(image_bytes)
+
+
+# Типы частей Responses API, в которых лежит текст ответа.
+_OUTPUT_TEXT_TYPES = frozenset(("output_text", "text"))
 
-def _guess_mime(image_bytes: bytes) -> str:
-    # Очень простой guess — достаточно для большинства фото из Telegram.
-    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
-        return "image/png"
-    if image_bytes.startswith(b"\xff\xd8"):
-        return "image/jpeg"
-    return "application/octet-stream"
+
+def _iter_responses_output_text(out: list[Any]) -> Iterator[str]:
+    for item in out:
+        if not isinstance(item, dict):
+            continue
+        content = item.get("content")
+        if not isinstance(content, list):
+            continue
+        for c in content:
+            if isinstance(c, dict) and c.get("type") in _OUTPUT_TEXT_TYPES:
+                text = c.get("text")
+                if isinstance(text, str):
+                    yield text
 
 
 def _extract_text_from_responses_api(data: dict[str, Any]) -> str:
@@ -41,45 +232,54 @@ def _extract_text_from_responses_api(data: dict[str, Any]) -> str:
     if not isinstance(out, list):
         return ""
 
-    parts: list[str] = []
-    for item in out:
-        if not isinstance(item, dict):
-            continue
-        content = item.get("content")
-        if not isinstance(content, list):
-            continue
-        for c in content:
-            if not isinstance(c, dict):
-                continue
-            if c.get("type") in ("output_text", "text") and isinstance(c.get("text"), str):
-                parts.append(c["text"])
-    return "\n".join(parts)
+    # Части текста склеиваются одним join прямо из генератора, без промежуточного списка.
+    return "\n".join(_iter_responses_output_text(out))
+
+# Маркеры списка и пробелы по краям варианта ответа.
+_OPTION_EDGES = re.compile(r"^[\s\-•]+|[\s\-•]+$")
+
 
 def _normalize_options(text: str, options_count: int) -> list[str]:
     """
     Нормализует варианты опроса: убирает пустые, дубли, лишние символы.
     """
-    lines = [ln.strip(" -•\t") for ln in text.splitlines()]
-    options: list[str] = []
-    for ln in lines:
-        ln = ln.strip()
-        if not ln:
-            continue
-        if ln not in options:
-            options.append(ln)
-        if len(options) >= options_count:
-            break
+    # dict вместо списка: проверка дубля по хэшу, порядок вставки сохраняется.
+    options: dict[str, None] = {}
+    for ln in text.splitlines():
+        ln = _OPTION_EDGES.sub("", ln)
+        if ln:
+            options[ln] = None
+            if len(options) >= options_count:
+                break
 
     # Если модель вернула всё в одну строку через запятые
     if len(options) < 2 and "," in text:
-        parts = [p.strip() for p in text.split(",")]
-        for p in parts:
-            if p and p not in options:
-                options.append(p)
-            if len(options) >= options_count:
-                break
+        for p in text.split(","):
+            p = p.strip()
+            if p:
+                options[p] = None
+                if len(options) >= options_count:
+                    break
 
-    return options[:options_count]
+    return list(options)[:options_count]
+
+
+def _iter_content_parts(content: list[Any]) -> Iterator[str]:
+    for p in content:
+        if isinstance(p, str):
+            yield p
+        elif isinstance(p, dict):
+            if isinstance(text := p.get("text"), str):
+                yield text
+            # иногда встречается {"type":"text","content":"..."}
+            elif isinstance(text := p.get("content"), str):
+                yield text
+
+
+# Где искать текст в annotations и в JSON arguments tool call — в порядке приоритета
+# (поэтому кортежи, а не множества).
+_ANNOTATION_TEXT_KEYS = ("text", "content", "annotation", "value", "message")
+_TOOL_CALL_TEXT_KEYS = ("caption", "text", "answer", "result", "output")
 
 
 def _extract_text_from_chat_completions(data: dict[str, Any]) -> str:
@@ -89,6 +289,15 @@ def _extract_text_from_chat_completions(data: dict[str, Any]) -> str:
     - choices[0].message.content: [{"type":"text","text":"..."}]
     - choices[0].text (редко/legacy)
     """
+    # Быстрый путь для обычного ответа OpenAI: непустая строка в choices[0].message.content.
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        pass
+    else:
+        if isinstance(content, str) and content.strip():
+            return content
+
     choices = data.get("choices") or []
     if not choices:
         return ""
@@ -102,39 +311,32 @@ def _extract_text_from_chat_completions(data: dict[str, Any]) -> str:
     msg = c0.get("message") or {}
     content = msg.get("content")
 
-    if isinstance(content, str):
-        # Некоторые прокси кладут отказ отдельно, а content оставляют пустым.
-        if not content.strip() and isinstance(msg.get("refusal"), str) and msg["refusal"].strip():
-            return msg["refusal"]
-        # Иногда текст попадает в annotations.
-        if not content.strip():
-            ann = msg.get("annotations")
-            if isinstance(ann, list):
-                for a in ann:
-                    if not isinstance(a, dict):
-                        continue
-                    for k in ("text", "content", "annotation", "value", "message"):
-                        v = a.get(k)
-                        if isinstance(v, str) and v.strip():
-                            return v
+    if isinstance(content, str) and content.strip():
         return content
 
     # content as list of parts
     if isinstance(content, list):
-        parts: list[str] = []
-        for p in content:
-            if isinstance(p, str):
-                parts.append(p)
+        text = "\n".join(_iter_content_parts(content))
+        if text.strip():
+            return text
+
+    # Пустой content (None, "" или пустые части): ответ может лежать рядом —
+    # проверяем всё, что уже пришло, прежде чем вызывающий код пойдёт на сетевой ретрай.
+
+    # Некоторые прокси кладут отказ отдельно, а content оставляют пустым.
+    refusal = msg.get("refusal")
+    if isinstance(refusal, str) and refusal.strip():
+        return refusal
+
+    # Иногда текст попадает в annotations.
+    ann = msg.get("annotations")
+    if isinstance(ann, list):
+        for a in ann:
+            if not isinstance(a, dict):
                 continue
-            if isinstance(p, dict):
-                if isinstance(p.get("text"), str):
-                    parts.append(p["text"])
-                    continue
-                # иногда встречается {"type":"text","content":"..."}
-                if isinstance(p.get("content"), str):
-                    parts.append(p["content"])
-                    continue
-        return "\n".join(parts)
+            for k in _ANNOTATION_TEXT_KEYS:
+                if isinstance(v := a.get(k), str) and v.strip():
+                    return v
 
     # tool calls (иногда content пустой, а ответ лежит в arguments)
     tool_calls = msg.get("tool_calls")
@@ -149,20 +351,28 @@ def _extract_text_from_chat_completions(data: dict[str, Any]) -> str:
             if not isinstance(args, str) or not args.strip():
                 continue
             # Попробуем распарсить JSON arguments и достать распространённые поля.
-            try:
-                obj = json.loads(args)
-                if isinstance(obj, dict):
-                    for k in ("caption", "text", "answer", "result", "output"):
-                        v = obj.get(k)
-                        if isinstance(v, str) and v.strip():
-                            return v
-            except Exception:
-                pass
+            # Парсер зовём только для объекта: обычный текст в arguments сразу отдаём как есть.
+            if args.lstrip().startswith("{"):
+                try:
+                    obj = orjson.loads(args)
+                except orjson.JSONDecodeError:
+                    pass
+                else:
+                    if isinstance(obj, dict):
+                        for k in _TOOL_CALL_TEXT_KEYS:
+                            if isinstance(v := obj.get(k), str) and v.strip():
+                                return v
             return args
 
     return ""
 
 
+def _extract_text(data: dict[str, Any]) -> str:
+    # Сначала OpenAI chat.completions (там же быстрый путь для обычного ответа),
+    # затем Responses API — некоторые прокси отвечают в этом формате.
+    return _extract_text_from_chat_completions(data) or _extract_text_from_responses_api(data)
+
+
 def _finish_reason_from_chat_completions(data: dict[str, Any]) -> str | None:
     choices = data.get("choices")
     if isinstance(choices, list) and choices:
@@ -180,14 +390,14 @@ def _response_meta(data: dict[str, Any]) -> dict[str, Any]:
         "id": data.get("id") or data.get("response_id"),
         "object": data.get("object"),
         "model": data.get("model"),
-        "keys": sorted(list(data.keys()))[:50],
+        "keys": heapq.nsmallest(50, data),
     }
     choices = data.get("choices")
     if isinstance(choices, list) and choices:
         c0 = choices[0] if isinstance(choices[0], dict) else {}
         meta["finish_reason"] = c0.get("finish_reason")
         msg = c0.get("message") if isinstance(c0.get("message"), dict) else {}
-        meta["message_keys"] = sorted(list(msg.keys()))[:50] if isinstance(msg, dict) else None
+        meta["message_keys"] = heapq.nsmallest(50, msg) if isinstance(msg, dict) else None
         # content может быть None/""/list — фиксируем тип
         meta["content_type"] = type(msg.get("content")).__name__ if isinstance(msg, dict) else None
         if isinstance(msg, dict):
@@ -200,195 +410,363 @@ def _response_meta(data: dict[str, Any]) -> dict[str, Any]:
     return meta
 
 
+def _response_id_suffix(data: dict[str, Any]) -> str:
+    """
+    « (response_id=...)» для текста ошибки — чтобы найти запрос в логах провайдера.
+    """
+    response_id = (
+        data.get("response_id")
+        or data.get("id")
+        or data.get("request_id")
+        or data.get("trace_id")
+        or data.get("x_request_id")
+    )
+    return f" (response_id={response_id})" if response_id else ""
+
+
+# Переводы строк и табы -> пробел одним проходом (вместо цепочки replace/strip).
+_NL_TRANS = str.maketrans({"\n": " ", "\r": " ", "\t": " "})
+
+
+def _clean(text: str | None) -> str:
+    return (text or "").translate(_NL_TRANS).strip()
+
+
 def _normalize_question(text: str) -> str:
-    text = (text or "").strip().strip("“”\"'`")
-    text = text.replace("\n", " ").strip()
+    text = _clean((text or "").strip().strip("“”\"'`"))
     if text and not text.endswith("?"):
         text = text.rstrip(".") + "?"
     return text
 
 
-async def generate_funny_caption(image_bytes: bytes, original_caption: str | None) -> str:
+# Тела меньше этого не сжимаем: выигрыш меньше накладных расходов.
+_GZIP_MIN_BODY = 4 * 1024
+
+# Повторы одного POST при временных сбоях. Таймауты не повторяем: генерация и так шла timeout_s.
+_POST_ATTEMPTS = 3
+_TRANSIENT_STATUSES = frozenset((429, 502, 503, 504))
+_TRANSIENT_ERRORS = (httpx.ConnectError, httpx.RemoteProtocolError)
+
+
+async def _post(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict[str, str],
+    payload: dict[str, Any],
+) -> httpx.Response:
+    body = orjson.dumps(payload)
+    if get_settings().timeweb_ai_gzip_requests and len(body) >= _GZIP_MIN_BODY:
+        # base64 картинки сжимается примерно на четверть; сжатие сотен КБ — тоже не для event loop.
+        body = await asyncio.to_thread(gzip.compress, body, 1)
+        headers = {**headers, "Content-Encoding": "gzip"}
+
+    # Временные сбои (перегруз, упавшее keep-alive соединение) повторяем с экспоненциальной паузой
+    # и джиттером; тело уже сериализовано — повтор его не пересобирает.
+    attempt = 0
+    while True:
+        last = attempt >= _POST_ATTEMPTS - 1
+        try:
+            r = await client.post(url, headers=headers, content=body)
+        except _TRANSIENT_ERRORS:
+            if last:
+                raise
+        else:
+            if last or r.status_code not in _TRANSIENT_STATUSES:
+                return r
+        await asyncio.sleep(min(0.5 * 2**attempt, 4.0) * (0.5 + random.random()))
+        attempt += 1
+
+
+# Признаки ошибки «temperature можно только по умолчанию»; ищем в байтах начала тела, без декодирования.
+_TEMPERATURE_MARKER = b"temperature"
+_TEMPERATURE_DEFAULT_MARKER = b"Only the default"
+_ERROR_SCAN_BYTES = 1024
+
+
+def _error_snippet(r: httpx.Response) -> str:
+    # Для сообщения об ошибке декодируем только начало тела, а не весь ответ целиком.
+    return r.content[:500].decode("utf-8", "replace")
+
+
+# Модели, которые уже отвергли temperature: дальше в этом процессе её им не шлём,
+# чтобы не платить лишним запросом за каждую подпись.
+_TEMPERATURE_BANNED: set[str] = set()
+
+
+def _temperature(settings: Settings) -> float | None:
+    if settings.timeweb_ai_model in _TEMPERATURE_BANNED:
+        return None
+    return settings.timeweb_ai_temperature
+
+
+def _is_temperature_rejection(body: bytes) -> bool:
+    head = body[:_ERROR_SCAN_BYTES]
+    return _TEMPERATURE_MARKER in head and _TEMPERATURE_DEFAULT_MARKER in head
+
+
+async def _post_chat(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict[str, str],
+    payload: dict[str, Any],
+) -> dict[str, Any]:
     """
-    Пытаемся получить 1 короткую смешную подпись к картинке через AI-агента Timeweb.
-    Реализация рассчитана на OpenAI-совместимый endpoint /v1/chat/completions.
+    Один POST в chat-completions: статус, ретрай без temperature, разбор JSON.
     """
-    mime = _guess_mime(image_bytes)
-    b64 = base64.b64encode(image_bytes).decode("ascii")
-    data_url = f"data:{mime};base64,{b64}"
+    r = await _post(client, url, headers, payload)
 
-    # Важно: просим вернуть ТОЛЬКО подпись, без кавычек и пояснений.
-    # original_caption может помочь, если в посте уже есть контекст/тема.
-    user_text = (
-        "Придумай одну короткую смешную подпись (до 120 символов) к картинке. "
-        "Верни только подпись, без кавычек, без хэштегов, без объяснений."
-    )
-    if original_caption:
-        user_text += f"\nКонтекст/подпись автора поста: {original_caption}"
+    # Если модель ругается на temperature — пробуем один раз без него.
+    # payload меняется на месте: следующие запросы с ним тоже уйдут без temperature,
+    # а модель запоминаем — новые запросы соберутся уже без неё.
+    if r.status_code == 400 and "temperature" in payload and _is_temperature_rejection(r.content):
+        payload.pop("temperature", None)
+        _TEMPERATURE_BANNED.add(payload["model"])
+        r = await _post(client, url, headers, payload)
 
-    settings = get_settings()
+    if r.status_code >= 400:
+        hint = ""
+        if r.status_code == 404:
+            hint = f" (проверьте TIMEWEB_AI_BASE_URL/TIMEWEB_AI_CHAT_PATH; текущий URL: {url})"
+        raise TimewebAIError(f"Timeweb AI HTTP {r.status_code}: {_error_snippet(r)}{hint}")
 
-    def _build_messages(
-        include_image: bool,
-        system_override: str | None = None,
-        emoji_mode: bool = False,
-    ) -> list[dict[str, Any]]:
-        system_text = system_override or (
-            "Ты — инженерный бот космической исследовательской станции в стиле научной фантастики. "
-            "Дружелюбный и смешной, иногда меланхоличный, иногда мечтательный. "
-            "Твоя задача — смешно, но без токсичности, оскорблений и политики. "
-        )
+    return orjson.loads(r.content)
 
-        if emoji_mode:
-            user_text = (
-                "Сделай emoji-реакцию на картинку: 3–5 эмодзи + короткая подпись. "
-                "Верни одну строку, без кавычек и хэштегов."
-            )
-        else:
-            user_text = (
-                "Придумай одну короткую смешную подпись (до 280 символов) к картинке. "
-                "Верни только подпись, без кавычек, без хэштегов, без объяснений."
-            )
-        if settings.timeweb_ai_use_post_caption and original_caption:
-            user_text += f"\nКонтекст/подпись автора поста: {original_caption}"
-
-        if include_image:
-            user_content: Any = [
-                {"type": "text", "text": user_text},
-                {"type": "image_url", "image_url": {"url": data_url}},
-            ]
-        else:
-            # Фолбэк: если vision не поддерживается — пусть хотя бы придумает подпись по контексту.
-            user_content = user_text + "\nЕсли ты не видишь изображение, всё равно верни смешную подпись."
 
-        return [
-            {"role": "system", "content": system_text},
-            {"role": "user", "content": user_content},
-        ]
+def _caption_text(data: dict[str, Any]) -> str:
+    # Чуть-чуть «очистки», чтобы бот не прислал пустое или многословное.
+    return _clean(_extract_text(data))
 
-    # Случайно выбираем режим: обычная подпись или emoji-реакция.
-    ratio = max(0.0, min(1.0, float(settings.timeweb_ai_emoji_ratio)))
-    emoji_mode = random.random() < ratio
 
+# Лимит токенов для ретрая, когда модель отрезала ответ по длине ещё до появления текста.
+_LENGTH_RETRY_MAX_TOKENS = 2048
+_TEXT_RESPONSE_FORMAT = {"type": "text"}
+
+
+def _chat_payload(
+    model: str,
+    messages: list[dict[str, Any]],
+    max_tokens: int,
+    temperature: float | None = None,
+    response_format: dict[str, str] | None = None,
+) -> dict[str, Any]:
+    """
+    Тело запроса chat-completions. Ретраи собирают своё тело здесь же, а не копируют
+    основное: общими остаются только нужные части (сообщения, data URL), явно по ссылке.
+    """
     payload: dict[str, Any] = {
-        "model": settings.timeweb_ai_model,
-        "messages": _build_messages(
-            include_image=bool(settings.timeweb_ai_send_image),
-            emoji_mode=emoji_mode,
-        ),
+        "model": model,
+        "messages": messages,
         # Некоторые современные модели/провайдеры (в т.ч. через OpenAI-совместимые прокси)
         # используют max_completion_tokens вместо max_tokens.
-        "max_completion_tokens": int(settings.timeweb_ai_max_completion_tokens),
+        "max_completion_tokens": max_tokens,
     }
     # Некоторые модели запрещают менять temperature (разрешено только значение по умолчанию).
     # Поэтому по умолчанию мы temperature НЕ отправляем.
-    if settings.timeweb_ai_temperature is not None:
-        payload["temperature"] = settings.timeweb_ai_temperature
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if response_format is not None:
+        payload["response_format"] = response_format
+    return payload
+
+
+# Кэш подписей: (blake2b картинки, контекст, emoji_mode) -> (подпись, срок истечения по time.monotonic()).
+_CaptionKey = tuple[bytes, str | None, bool]
+_CAPTION_CACHE: OrderedDict[_CaptionKey, tuple[str, float]] = OrderedDict()
+_CAPTION_CACHE_TTL_S = 60 * 60
+_CAPTION_CACHE_MAX = 1_000
+# Запросы подписи «в работе»: повторный такой же запрос ждёт их, а не идёт в AI второй раз.
+_CAPTION_INFLIGHT: dict[_CaptionKey, asyncio.Task[str]] = {}
+
+
+def _build_caption_messages(
+    user_text: str,
+    data_url: str | None,
+    system_text: str = _CAPTION_SYSTEM_PROMPT,
+) -> list[dict[str, Any]]:
+    """
+    Сообщения для подписи. data_url=None — запрос без картинки.
+    """
+    if data_url is not None:
+        user_content: Any = [
+            {"type": "text", "text": user_text},
+            {"type": "image_url", "image_url": {"url": data_url}},
+        ]
+    else:
+        # Фолбэк: если vision не поддерживается — пусть хотя бы придумает подпись по контексту.
+        user_content = user_text + _NO_IMAGE_SUFFIX
 
-    base = settings.timeweb_ai_base_url.rstrip("/")
-    path = settings.timeweb_ai_chat_path.strip()
-    if not path.startswith("/"):
-        path = "/" + path
-    url = base + path
-    headers = {
-        "Authorization": f"Bearer {settings.timeweb_ai_api_key}",
-        "Content-Type": "application/json",
-    }
+    return [
+        {"role": "system", "content": system_text},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def _image_digest(image_bytes: ImageBytes) -> bytes:
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
 
-    async with httpx.AsyncClient(timeout=settings.timeweb_ai_timeout_s) as client:
-        r = await client.post(url, headers=headers, json=payload)
 
-        # Если модель ругается на temperature — пробуем один раз без него.
-        if r.status_code == 400 and "temperature" in r.text and "Only the default" in r.text:
-            payload.pop("temperature", None)
-            r = await client.post(url, headers=headers, json=payload)
+def _caption_done(key: _CaptionKey, task: asyncio.Task[str]) -> None:
+    """
+    Готовая подпись попадает в кэш, запрос снимается из «в работе».
+    """
+    if _CAPTION_INFLIGHT.get(key) is task:
+        del _CAPTION_INFLIGHT[key]
+    # Ошибку забираем всегда: все ожидающие могли уже уйти, asyncio не должен ругаться в лог.
+    if task.cancelled() or task.exception() is not None:
+        return
+    _CAPTION_CACHE[key] = (task.result(), time.monotonic() + _CAPTION_CACHE_TTL_S)
+    _CAPTION_CACHE.move_to_end(key)
+    if len(_CAPTION_CACHE) > _CAPTION_CACHE_MAX:
+        _CAPTION_CACHE.popitem(last=False)
+
+
+async def generate_funny_caption(
+    image_bytes: ImageBytes,
+    original_caption: str | None,
+    use_cache: bool = True,
+) -> str:
+    """
+    Пытаемся получить 1 короткую смешную подпись к картинке через AI-агента Timeweb.
+    Реализация рассчитана на OpenAI-совместимый endpoint /v1/chat/completions.
+
+    Одна и та же картинка (репосты, пересылки) с тем же контекстом и режимом берёт подпись
+    из кэша, а одновременные одинаковые запросы ждут один общий вызов AI.
+    use_cache=False — всегда новая подпись (перегенерация из админки); она заменит кэшированную.
+    """
+    settings = get_settings()
 
-        if r.status_code >= 400:
-            hint = ""
-            if r.status_code == 404:
-                hint = f" (проверьте TIMEWEB_AI_BASE_URL/TIMEWEB_AI_CHAT_PATH; текущий URL: {url})"
-            raise TimewebAIError(f"Timeweb AI HTTP {r.status_code}: {r.text[:500]}{hint}")
+    if settings.timeweb_ai_send_image:
+        _check_image_size(image_bytes, settings.timeweb_ai_max_image_bytes)
 
-        data = r.json()
+    # Случайно выбираем режим: обычная подпись или emoji-реакция.
+    ratio = max(0.0, min(1.0, float(settings.timeweb_ai_emoji_ratio)))
+    emoji_mode = random.random() < ratio
+    if not settings.timeweb_ai_use_post_caption:
+        original_caption = None
+
+    key = (await _image_cpu(_image_digest, image_bytes), original_caption, emoji_mode)
+
+    if use_cache:
+        cached = _CAPTION_CACHE.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            _CAPTION_CACHE.move_to_end(key)
+            return cached[0]
+        task = _CAPTION_INFLIGHT.get(key)
+    else:
+        task = None
+
+    if task is None:
+        task = asyncio.ensure_future(_generate_caption(settings, image_bytes, original_caption, emoji_mode))
+        if use_cache:
+            _CAPTION_INFLIGHT[key] = task
+        task.add_done_callback(partial(_caption_done, key))
+    # shield: отмена одного ожидающего не отменяет общий запрос для остальных.
+    return await asyncio.shield(task)
+
+
+async def _generate_caption(
+    settings: Settings,
+    image_bytes: ImageBytes,
+    original_caption: str | None,
+    emoji_mode: bool,
+) -> str:
+    # Без отправки картинки (TIMEWEB_AI_SEND_IMAGE=false) data URL не нужен вовсе.
+    data_url = await _image_cpu(_image_data_url, image_bytes) if settings.timeweb_ai_send_image else None
 
-    # Сначала пробуем OpenAI chat.completions, затем Responses API (некоторые прокси так отвечают).
-    text = _extract_text_from_chat_completions(data)
-    if not text:
-        text = _extract_text_from_responses_api(data)
+    # Важно: просим вернуть ТОЛЬКО подпись, без кавычек и пояснений.
+    # original_caption может помочь, если в посте уже есть контекст/тема.
+    # Текст собираем один раз — он общий для основного запроса и ретраев.
+    user_text = _EMOJI_USER_PROMPT if emoji_mode else _CAPTION_USER_PROMPT
+    if original_caption:
+        user_text += _CAPTION_CONTEXT_PREFIX + original_caption
 
-    text = (text or "").strip()
-    # Чуть-чуть «очистки», чтобы бот не прислал пустое или многословное.
-    text = text.replace("\n", " ").strip()
+    model = settings.timeweb_ai_model
+    max_tokens = int(settings.timeweb_ai_max_completion_tokens)
+    payload = _chat_payload(
+        model, _build_caption_messages(user_text, data_url), max_tokens, _temperature(settings)
+    )
 
-    # Если вдруг пришёл пустой текст (иногда бывает у прокси/агентов) — делаем ретраи:
-    # 1) более жёсткая инструкция
-    # 2) фолбэк без картинки (если vision не поддерживается)
-    if not text:
-        # Если модель отрезала ответ по длине ещё до появления текста — попробуем ретрай с большим лимитом.
-        finish_reason = _finish_reason_from_chat_completions(data)
-        if finish_reason == "length":
-            payload_more = dict(payload)
-            payload_more["max_completion_tokens"] = max(int(payload.get("max_completion_tokens", 0) or 0), 2048)
-            async with httpx.AsyncClient(timeout=settings.timeweb_ai_timeout_s) as client:
-                r_more = await client.post(url, headers=headers, json=payload_more)
-                if r_more.status_code >= 400:
-                    raise TimewebAIError(f"Timeweb AI HTTP {r_more.status_code}: {r_more.text[:500]}")
-                data_more = r_more.json()
-            text = (_extract_text_from_chat_completions(data_more) or _extract_text_from_responses_api(data_more)).strip()
-            text = text.replace("\n", " ").strip()
-
-        if text:
-            return text[:400]
-
-        payload_retry = dict(payload)
-        payload_retry["messages"] = _build_messages(
-            include_image=bool(settings.timeweb_ai_send_image),
-            system_override=(
-                "Ты пишешь подписи к картинкам. Ответ НЕ может быть пустым. "
-                "Верни одну короткую подпись, только текст."
-            ),
-            emoji_mode=emoji_mode,
+    url, headers = _endpoint()
+
+    client = _get_client()
+    data = await _post_chat(client, url, headers, payload)
+    text = _caption_text(data)
+    if text:
+        return text[:400]
+
+    # Если вдруг пришёл пустой текст (иногда бывает у прокси/агентов) — ретраи.
+    # Уходят параллельно (ждём не сумму, а самый медленный из нужных), но ответ берём
+    # в порядке приоритета — первый непустой:
+    # 1) модель отрезала ответ по длине ещё до появления текста — больший лимит
+    # 2) более жёсткая инструкция
+    # 3) фолбэк без картинки (если vision не поддерживается)
+    # _post_chat мог убрать temperature из payload (модель её не принимает) — ретраи без неё же.
+    temperature = payload.get("temperature")
+    retries: list[dict[str, Any]] = []
+    if _finish_reason_from_chat_completions(data) == "length":
+        retries.append(
+            _chat_payload(model, payload["messages"], max(max_tokens, _LENGTH_RETRY_MAX_TOKENS), temperature)
+        )
+    retries.append(
+        _chat_payload(
+            model,
+            _build_caption_messages(user_text, data_url, system_text=_CAPTION_STRICT_SYSTEM_PROMPT),
+            max_tokens,
+            temperature,
         )
+    )
+    if data_url is not None:
+        retries.append(_chat_payload(model, _build_caption_messages(user_text, None), max_tokens, temperature))
+
+    tasks = [asyncio.create_task(_post_chat(client, url, headers, p)) for p in retries]
+    try:
+        for task in tasks:
+            text = _caption_text(await task)
+            if text:
+                return text[:400]
+    finally:
+        # Оставшиеся ретраи больше не нужны; их ошибки забираем, чтобы asyncio не ругался в лог.
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    suffix = _response_id_suffix(data)
+    # Пишем в лог безопасные метаданные ответа, чтобы понять формат/причину пустоты.
+    try:
+        logger.error("Timeweb AI empty response meta: %s", _response_meta(data))
+    except Exception:
+        pass
+    raise TimewebAIError(f"AI вернул пустую подпись{suffix}")
+
+
+def _poll_user_content(prompt: str, data_url: str) -> list[dict[str, Any]]:
+    return [
+        {"type": "text", "text": prompt},
+        {"type": "image_url", "image_url": {"url": data_url}},
+    ]
 
-        async with httpx.AsyncClient(timeout=settings.timeweb_ai_timeout_s) as client:
-            r2 = await client.post(url, headers=headers, json=payload_retry)
-            if r2.status_code >= 400:
-                raise TimewebAIError(f"Timeweb AI HTTP {r2.status_code}: {r2.text[:500]}")
-            data2 = r2.json()
-        text = _extract_text_from_chat_completions(data2) or _extract_text_from_responses_api(data2)
-        text = (text or "").strip().replace("\n", " ").strip()
-
-        if not text and settings.timeweb_ai_send_image:
-            payload_retry2 = dict(payload)
-            payload_retry2["messages"] = _build_messages(include_image=False, emoji_mode=emoji_mode)
-            async with httpx.AsyncClient(timeout=settings.timeweb_ai_timeout_s) as client:
-                r3 = await client.post(url, headers=headers, json=payload_retry2)
-                if r3.status_code >= 400:
-                    raise TimewebAIError(f"Timeweb AI HTTP {r3.status_code}: {r3.text[:500]}")
-                data3 = r3.json()
-            text = _extract_text_from_chat_completions(data3) or _extract_text_from_responses_api(data3)
-            text = (text or "").strip().replace("\n", " ").strip()
 
-        if not text:
-            response_id = (
-                data.get("response_id")
-                or data.get("id")
-                or data.get("request_id")
-                or data.get("trace_id")
-                or data.get("x_request_id")
-            )
-            suffix = f" (response_id={response_id})" if response_id else ""
-            # Пишем в лог безопасные метаданные ответа, чтобы понять формат/причину пустоты.
-            try:
-                logger.error("Timeweb AI empty response meta: %s", _response_meta(data))
-            except Exception:
-                pass
-            raise TimewebAIError(f"AI вернул пустую подпись{suffix}")
-
-    return text[:400]
-
-
-async def generate_poll_question(image_bytes: bytes) -> str:
+def _poll_messages(system_text: str, user_content: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return [
+        {"role": "system", "content": system_text},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def _poll_payload(settings: Settings, messages: list[dict[str, Any]], temperature: float | None) -> dict[str, Any]:
+    """
+    Запрос для вопроса/вариантов опроса: общий для обоих генераторов, различаются только сообщения.
+    """
+    return _chat_payload(
+        settings.timeweb_ai_model,
+        messages,
+        int(settings.timeweb_ai_max_completion_tokens),
+        temperature,
+        _TEXT_RESPONSE_FORMAT,
+    )
+
+
+async def generate_poll_question(image_bytes: ImageBytes) -> str:
     """
     Генерирует короткий универсальный вопрос по картинке.
     Возвращает одну строку.
@@ -397,113 +775,46 @@ async def generate_poll_question(image_bytes: bytes) -> str:
     if not settings.timeweb_ai_send_image:
         raise TimewebAIError("Для опросов требуется TIMEWEB_AI_SEND_IMAGE=true")
 
-    mime = _guess_mime(image_bytes)
-    b64 = base64.b64encode(image_bytes).decode("ascii")
-    data_url = f"data:{mime};base64,{b64}"
-
-    user_content: Any = [
-        {
-            "type": "text",
-            "text": (
-                "Придумай короткий универсальный и смешной вопрос для опроса по предоставленной картинке. "
-                "Один вопрос, 3–8 слов, без кавычек и нумерации. "
-                "Верни только вопрос одной строкой."
-            ),
-        },
-        {"type": "image_url", "image_url": {"url": data_url}},
-    ]
-
-    payload: dict[str, Any] = {
-        "model": settings.timeweb_ai_model,
-        "messages": [
-            {
-                "role": "system",
-                "content": "Ты придумываешь короткие вопросы для опросов по картинке.",
-            },
-            {
-                "role": "user",
-                "content": user_content,
-            },
-        ],
-        "max_completion_tokens": int(settings.timeweb_ai_max_completion_tokens),
-        "response_format": {"type": "text"},
-    }
-    if settings.timeweb_ai_temperature is not None:
-        payload["temperature"] = settings.timeweb_ai_temperature
+    _check_image_size(image_bytes, settings.timeweb_ai_max_image_bytes)
+    data_url = await _image_cpu(_image_data_url, image_bytes)
 
-    base = settings.timeweb_ai_base_url.rstrip("/")
-    path = settings.timeweb_ai_chat_path.strip()
-    if not path.startswith("/"):
-        path = "/" + path
-    url = base + path
-    headers = {
-        "Authorization": f"Bearer {settings.timeweb_ai_api_key}",
-        "Content-Type": "application/json",
-    }
+    user_content = _poll_user_content(_POLL_QUESTION_USER_PROMPT, data_url)
+    payload = _poll_payload(
+        settings, _poll_messages(_POLL_QUESTION_SYSTEM_PROMPT, user_content), _temperature(settings)
+    )
 
-    async with httpx.AsyncClient(timeout=settings.timeweb_ai_timeout_s) as client:
-        r = await client.post(url, headers=headers, json=payload)
-        if r.status_code >= 400:
-            raise TimewebAIError(f"Timeweb AI HTTP {r.status_code}: {r.text[:500]}")
-        data = r.json()
+    url, headers = _endpoint()
+    client = _get_client()
 
-        text = _extract_text_from_chat_completions(data) or _extract_text_from_responses_api(data)
-        text = _normalize_question(text)
+    data = await _post_chat(client, url, headers, payload)
+    text = _normalize_question(_extract_text(data))
 
-        if not text:
-            finish_reason = _finish_reason_from_chat_completions(data)
-            if finish_reason == "length":
-                payload_more = dict(payload)
-                payload_more["max_completion_tokens"] = max(
-                    int(payload.get("max_completion_tokens", 0) or 0), 2048
-                )
-                r_more = await client.post(url, headers=headers, json=payload_more)
-                if r_more.status_code >= 400:
-                    raise TimewebAIError(f"Timeweb AI HTTP {r_more.status_code}: {r_more.text[:500]}")
-                data = r_more.json()
-                text = _normalize_question(
-                    _extract_text_from_chat_completions(data) or _extract_text_from_responses_api(data)
-                )
+    if not text and _finish_reason_from_chat_completions(data) == "length":
+        payload_more = _chat_payload(
+            settings.timeweb_ai_model,
+            payload["messages"],
+            max(payload["max_completion_tokens"], _LENGTH_RETRY_MAX_TOKENS),
+            payload.get("temperature"),
+            _TEXT_RESPONSE_FORMAT,
+        )
+        data = await _post_chat(client, url, headers, payload_more)
+        text = _normalize_question(_extract_text(data))
 
+    if not text:
+        payload2 = _poll_payload(
+            settings, _poll_messages(_POLL_QUESTION_STRICT_SYSTEM_PROMPT, user_content), payload.get("temperature")
+        )
+        data = await _post_chat(client, url, headers, payload2)
+        text = _normalize_question(_extract_text(data))
         if not text:
-            payload2 = dict(payload)
-            payload2["messages"] = [
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты генерируешь вопрос для опроса по картинке. "
-                        "Ответ НЕ может быть пустым. Только один вопрос."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": payload["messages"][1]["content"],
-                },
-            ]
-            r2 = await client.post(url, headers=headers, json=payload2)
-            if r2.status_code >= 400:
-                raise TimewebAIError(f"Timeweb AI HTTP {r2.status_code}: {r2.text[:500]}")
-            data = r2.json()
-            text = _normalize_question(
-                _extract_text_from_chat_completions(data) or _extract_text_from_responses_api(data)
-            )
-            if not text:
-                response_id = (
-                    data.get("response_id")
-                    or data.get("id")
-                    or data.get("request_id")
-                    or data.get("trace_id")
-                    or data.get("x_request_id")
-                )
-                suffix = f" (response_id={response_id})" if response_id else ""
-                logger.error("Poll question empty response meta: %s", _response_meta(data))
-                raise TimewebAIError(f"AI вернул пустой вопрос опроса{suffix}")
+            logger.error("Poll question empty response meta: %s", _response_meta(data))
+            raise TimewebAIError(f"AI вернул пустой вопрос опроса{_response_id_suffix(data)}")
 
     return text[:200]
 
 
 async def generate_poll_options(
-    image_bytes: bytes,
+    image_bytes: ImageBytes,
     question: str,
     options_count: int,
 ) -> list[str]:
@@ -514,112 +825,40 @@ async def generate_poll_options(
     settings = get_settings()
     options_count = max(2, min(4, int(options_count)))
 
-    mime = _guess_mime(image_bytes)
-    b64 = base64.b64encode(image_bytes).decode("ascii")
-    data_url = f"data:{mime};base64,{b64}"
-
-    prompt = (
-        f"Сгенерируй {options_count} коротких СМЕШНЫХ вариантов ответа для опроса.\n"
-        f"Вопрос: «{question}»\n"
-        "Каждый вариант 2–6 слов, без нумерации, без кавычек, без хэштегов.\n"
-        "Верни только список вариантов, каждый в новой строке."
-    )
-
     if not settings.timeweb_ai_send_image:
         raise TimewebAIError("Для опросов требуется TIMEWEB_AI_SEND_IMAGE=true")
 
-    user_content: Any = [
-        {"type": "text", "text": prompt},
-        {"type": "image_url", "image_url": {"url": data_url}},
-    ]
+    _check_image_size(image_bytes, settings.timeweb_ai_max_image_bytes)
+    data_url = await _image_cpu(_image_data_url, image_bytes)
 
-    payload: dict[str, Any] = {
-        "model": settings.timeweb_ai_model,
-        "messages": [
-            {
-                "role": "system",
-                "content": (
-                    "Ты придумываешь варианты ответов для опросов по картинке. "
-                    "Текст короткий, нейтральный, без токсичности."
-                ),
-            },
-            {
-                "role": "user",
-                "content": user_content,
-            },
-        ],
-        "max_completion_tokens": int(settings.timeweb_ai_max_completion_tokens),
-        "response_format": {"type": "text"},
-    }
-    if settings.timeweb_ai_temperature is not None:
-        payload["temperature"] = settings.timeweb_ai_temperature
+    prompt = _POLL_OPTIONS_USER_PROMPT.format(options_count=options_count, question=question)
+    user_content = _poll_user_content(prompt, data_url)
+    payload = _poll_payload(
+        settings, _poll_messages(_POLL_OPTIONS_SYSTEM_PROMPT, user_content), _temperature(settings)
+    )
 
-    base = settings.timeweb_ai_base_url.rstrip("/")
-    path = settings.timeweb_ai_chat_path.strip()
-    if not path.startswith("/"):
-        path = "/" + path
-    url = base + path
-    headers = {
-        "Authorization": f"Bearer {settings.timeweb_ai_api_key}",
-        "Content-Type": "application/json",
-    }
+    url, headers = _endpoint()
+    client = _get_client()
 
-    async with httpx.AsyncClient(timeout=settings.timeweb_ai_timeout_s) as client:
-        # Попытка 1
-        r = await client.post(url, headers=headers, json=payload)
-        if r.status_code >= 400:
-            raise TimewebAIError(f"Timeweb AI HTTP {r.status_code}: {r.text[:500]}")
-        data = r.json()
+    # Попытка 1
+    data = await _post_chat(client, url, headers, payload)
+    text = _extract_text(data).strip()
 
-        # Попытка 2 (если пусто) — усиленный промпт
-        text = _extract_text_from_chat_completions(data) or _extract_text_from_responses_api(data)
-        text = (text or "").strip()
+    # Попытка 2 (если пусто) — усиленный промпт
+    if not text:
+        payload2 = _poll_payload(
+            settings, _poll_messages(_POLL_OPTIONS_STRICT_SYSTEM_PROMPT, user_content), payload.get("temperature")
+        )
+        data = await _post_chat(client, url, headers, payload2)
+        text = _extract_text(data).strip()
         if not text:
-            payload2 = dict(payload)
-            payload2["messages"] = [
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты генерируешь смешные варианты ответов для опроса. "
-                        "Ответ НЕ может быть пустым. Только варианты, каждый в новой строке."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": payload["messages"][1]["content"],
-                },
-            ]
-            r2 = await client.post(url, headers=headers, json=payload2)
-            if r2.status_code >= 400:
-                raise TimewebAIError(f"Timeweb AI HTTP {r2.status_code}: {r2.text[:500]}")
-            data = r2.json()
-            text = _extract_text_from_chat_completions(data) or _extract_text_from_responses_api(data)
-            text = (text or "").strip()
-            if not text:
-                response_id = (
-                    data.get("response_id")
-                    or data.get("id")
-                    or data.get("request_id")
-                    or data.get("trace_id")
-                    or data.get("x_request_id")
-                )
-                suffix = f" (response_id={response_id})" if response_id else ""
-                logger.error("Poll options empty response meta: %s", _response_meta(data))
-                raise TimewebAIError(f"AI вернул пустые варианты опроса{suffix}")
+            logger.error("Poll options empty response meta: %s", _response_meta(data))
+            raise TimewebAIError(f"AI вернул пустые варианты опроса{_response_id_suffix(data)}")
 
     options = _normalize_options(text, options_count)
 
     if len(options) < 2:
-        response_id = (
-            data.get("response_id")
-            or data.get("id")
-            or data.get("request_id")
-            or data.get("trace_id")
-            or data.get("x_request_id")
-        )
-        suffix = f" (response_id={response_id})" if response_id else ""
         logger.error("Poll options insufficient response meta: %s", _response_meta(data))
-        raise TimewebAIError(f"AI вернул недостаточно вариантов для опроса{suffix}")
+        raise TimewebAIError(f"AI вернул недостаточно вариантов для опроса{_response_id_suffix(data)}")
 
     return options[:options_count]
-